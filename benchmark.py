@@ -0,0 +1,172 @@
+#!/usr/bin/env python3 -u
+'''Micro-benchmarks for the training step.
+
+    python benchmark.py amp [--models ...] [--batch-size 16]
+    python benchmark.py mix [--batch-size 16]
+    python benchmark.py mixup_v2 [--models ResNet18 MobileNet ...] [--batch-size 16]
+    python benchmark.py channels_last [--models ...] [--batch-size 16]
+
+amp: train step time in fp32 vs. bfloat16 autocast (--amp bf16).
+
+mix: host time per call of every mixing strategy registered in mixup.MIXERS.
+
+mixup_v2: step time (forward + backward + SGD step) of --mixup_v2 with two
+forward passes vs. the fused single pass, with split and shared BatchNorm.
+
+channels_last: train step time with NCHW vs. channels_last weights and
+batches (--memory-format). Models that get slower are marked REGRESSION;
+--memory-format auto makes the same comparison before training.
+'''
+from __future__ import print_function
+
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+import models
+from mixup import MIXERS, Mixup, MixupCrossEntropy, build_mixer, split_batchnorm
+from utils import autocast
+
+# Constructors for the CIFAR models in models/, keyed by the --model name.
+MODELS = {
+    'ResNet18': lambda n: models.ResNet18(num_classes=n),
+    'densenet_cifar': lambda n: models.DenseNet(models.densenet.Bottleneck, [6, 12, 24, 16],
+                                                growth_rate=12, num_classes=n),
+    'MobileNet': lambda n: models.MobileNet(num_classes=n),
+    'ResNeXt29_2x64d': lambda n: models.ResNeXt(num_blocks=[3, 3, 3], cardinality=2,
+                                                bottleneck_width=64, num_classes=n),
+    'VGG11': lambda n: models.VGG('VGG11'),
+    'GoogLeNet': lambda n: models.GoogLeNet(),
+    'LeNet': lambda n: models.LeNet(),
+}
+
+
+def time_steps(step, steps, warmup=2):
+    '''Mean seconds per call of `step` after `warmup` untimed calls.'''
+    for _ in range(warmup):
+        step()
+    start = time.time()
+    for _ in range(steps):
+        step()
+    return (time.time() - start) / steps
+
+
+def bench_amp(args):
+    print('%-16s %10s %10s %8s' % ('model', 'fp32 ms', 'bf16 ms', 'speedup'))
+    for name in args.models:
+        net = MODELS[name](10)
+        net.train()
+        criterion = MixupCrossEntropy()
+        optimizer = optim.SGD(net.parameters(), lr=0.01, momentum=0.9)
+        mixer = Mixup(1.0)
+        inputs = torch.randn(args.batch_size, 3, 32, 32)
+        targets = torch.randint(0, 10, (args.batch_size,))
+
+        def step(amp):
+            def run():
+                with autocast(amp):
+                    mixed, targets_a, targets_b, lam = mixer(inputs, targets)
+                    loss = criterion(net(mixed), targets_a, targets_b, lam)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+            return run
+
+        t_fp32 = time_steps(step('none'), args.steps)
+        t_bf16 = time_steps(step('bf16'), args.steps)
+        print('%-16s %10.1f %10.1f %7.2fx' % (name, 1e3 * t_fp32, 1e3 * t_bf16, t_fp32 / t_bf16))
+
+
+def bench_mix(args):
+    inputs = torch.randn(args.batch_size, 3, 32, 32)
+    targets = torch.randint(0, 10, (args.batch_size,))
+    print('%-20s %12s %12s' % ('strategy', 'batch lam', 'per-sample'))
+    for name in sorted(MIXERS):
+        costs = []
+        for per_sample in (False, True):
+            mixer = build_mixer(name, 1.0, per_sample=per_sample, seed=0)
+            costs.append(time_steps(lambda: mixer(inputs, targets), 10 * args.steps))
+        print('%-20s %9.3f ms %9.3f ms' % (name, 1e3 * costs[0], 1e3 * costs[1]))
+
+
+def bench_mixup_v2(args):
+    print('%-16s %12s %12s %12s %8s' % ('model', 'two-pass ms', 'fused/split', 'fused/shared', 'speedup'))
+    for name in args.models:
+        net = MODELS[name](10)
+        net.train()
+        criterion = nn.CrossEntropyLoss()
+        mix_criterion = MixupCrossEntropy()
+        optimizer = optim.SGD(net.parameters(), lr=0.01, momentum=0.9)
+        mixer = Mixup(1.0)
+        inputs = torch.randn(args.batch_size, 3, 32, 32)
+        targets = torch.randint(0, 10, (args.batch_size,))
+
+        def loss_of(outputs1, outputs, targets_a, targets_b, lam):
+            return mix_criterion(outputs, targets_a, targets_b, lam) + criterion(outputs1, targets)
+
+        def two_pass():
+            outputs1 = net(inputs)
+            mixed, targets_a, targets_b, lam = mixer(inputs, targets)
+            outputs = net(mixed)
+            optimizer.zero_grad()
+            loss_of(outputs1, outputs, targets_a, targets_b, lam).backward()
+            optimizer.step()
+
+        def fused(groups):
+            def step():
+                n = inputs.size(0)
+                both = torch.empty((2 * n,) + inputs.shape[1:])
+                both[:n] = inputs
+                _, targets_a, targets_b, lam = mixer(inputs, targets, out=both[n:])
+                with split_batchnorm(net, groups):
+                    outputs1, outputs = net(both).split(n)
+                optimizer.zero_grad()
+                loss_of(outputs1, outputs, targets_a, targets_b, lam).backward()
+                optimizer.step()
+            return step
+
+        t_two = time_steps(two_pass, args.steps)
+        t_split = time_steps(fused(2), args.steps)
+        t_shared = time_steps(fused(1), args.steps)
+        print('%-16s %12.1f %12.1f %12.1f %7.2fx'
+              % (name, 1e3 * t_two, 1e3 * t_split, 1e3 * t_shared, t_two / min(t_split, t_shared)))
+
+
+def bench_channels_last(args):
+    print('%-16s %10s %10s %8s' % ('model', 'NCHW ms', 'NHWC ms', 'speedup'))
+    for name in args.models:
+        times = []
+        for memory_format in (torch.contiguous_format, torch.channels_last):
+            torch.manual_seed(0)
+            net = MODELS[name](10).to(memory_format=memory_format)
+            net.train()
+            criterion = MixupCrossEntropy()
+            optimizer = optim.SGD(net.parameters(), lr=0.01, momentum=0.9)
+            inputs = torch.randn(args.batch_size, 3, 32, 32).contiguous(memory_format=memory_format)
+            targets = torch.randint(0, 10, (args.batch_size,))
+
+            def step():
+                loss = criterion(net(inputs), targets)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+            times.append(time_steps(step, args.steps))
+        t_nchw, t_nhwc = times
+        print('%-16s %10.1f %10.1f %7.2fx%s' % (name, 1e3 * t_nchw, 1e3 * t_nhwc, t_nchw / t_nhwc,
+                                                 '  REGRESSION' if t_nhwc > t_nchw else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Training step micro-benchmarks')
+    parser.add_argument('bench', choices=['amp', 'mix', 'mixup_v2', 'channels_last'], help='benchmark to run')
+    parser.add_argument('--models', nargs='+', default=sorted(MODELS), choices=sorted(MODELS),
+                        help='models to benchmark (default: all)')
+    parser.add_argument('--batch-size', default=16, type=int, help='batch size')
+    parser.add_argument('--steps', default=10, type=int, help='timed steps per setting')
+    args = parser.parse_args()
+
+    {'amp': bench_amp, 'mix': bench_mix, 'mixup_v2': bench_mixup_v2,
+     'channels_last': bench_channels_last}[args.bench](args)
@@ -0,0 +1,133 @@
+'''Checkpoints as plain state dicts, written in the background.
+
+CheckpointWriter.save takes a CPU snapshot of the state (model, optimizer and
+RNG state dicts) on the calling thread, which is quick, and leaves the
+torch.save to a writer thread, so training does not wait for slow (network)
+filesystems. A file is written to `<path>.tmp`, synced and renamed over
+`<path>`, so readers only ever see complete checkpoints. If a newer
+checkpoint for the same path arrives while an older one is still waiting,
+only the newer one is written. With `keep` > 1 the previous versions are kept
+as `<path>.1` (newest) ... `<path>.<keep - 1>`.
+
+load_checkpoint reads checkpoints with weights_only=True. Checkpoints from
+before this format (a pickled network under 'net') are still loaded, with the
+network converted to its state dict.
+'''
+from __future__ import print_function
+
+import os
+import pickle
+import shutil
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def snapshot(state):
+    '''Copy of `state` with every tensor copied to the CPU (nested dicts/lists/tuples).'''
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, snapshot(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+class CheckpointWriter(object):
+    '''Write checkpoints on a background thread; see the module docstring.'''
+
+    def __init__(self, keep=1):
+        self.keep = keep
+        self.written = 0
+        self.coalesced = 0
+        self._pending = OrderedDict()
+        self._busy = False
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def save(self, state, path):
+        '''Snapshot `state` now and write it to `path` in the background.'''
+        self._raise()
+        state = snapshot(state)
+        with self._cond:
+            if self._pending.pop(path, None) is not None:
+                self.coalesced += 1
+            self._pending[path] = state
+            self._cond.notify_all()
+
+    def flush(self):
+        '''Wait until every checkpoint handed to `save` is on disk.'''
+        with self._cond:
+            while self._pending or self._busy:
+                self._cond.wait()
+        self._raise()
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                path, state = self._pending.popitem(last=False)
+                self._busy = True
+            try:
+                self._write(state, path)
+                self.written += 1
+            except Exception as e:
+                self._error = e
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def _write(self, state, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        if self.keep > 1 and os.path.exists(path):
+            for i in range(self.keep - 1, 1, -1):
+                if os.path.exists('%s.%d' % (path, i - 1)):
+                    os.replace('%s.%d' % (path, i - 1), '%s.%d' % (path, i))
+            # `path` stays in place until the rename below replaces it
+            if os.path.exists(path + '.1'):
+                os.remove(path + '.1')
+            try:
+                os.link(path, path + '.1')
+            except OSError:
+                shutil.copyfile(path, path + '.1')
+        os.replace(tmp, path)
+
+
+def load_checkpoint(path, map_location='cpu'):
+    '''Checkpoint dict at `path`; 'net' is always a state dict.'''
+    try:
+        state = torch.load(path, map_location=map_location, weights_only=True)
+    except pickle.UnpicklingError:
+        # Old format: the pickled network itself
+        print('Loading %s as a legacy (pickled network) checkpoint' % path)
+        state = torch.load(path, map_location=map_location, weights_only=False)
+    net = state['net']
+    if isinstance(net, torch.nn.Module):
+        net = getattr(net, 'module', net)
+        state['net'] = getattr(net, '_orig_mod', net).state_dict()
+    return state
@@ -0,0 +1,79 @@
+'''Graph compilation of the training models with torch.compile.
+
+compile_model compiles a freshly built network once per process for a given
+key (model name, classes, input and batch shape, mode): the first trial pays
+for compilation during an explicit warm-up, later trials copy their fresh
+weights into the cached module and reuse its graphs, so nothing recompiles.
+If compilation fails the eager network is used (and remembered, so the
+failure is not retried every trial).
+
+The warm-up runs a training forward/backward or an eval forward for each
+example batch (e.g. full and last partial batch, eval batch), so the graphs
+for both BatchNorm modes and all batch shapes exist before the first epoch
+starts; its wall time is what compile_model reports. Each example runs under
+the same context as the real step (e.g. mixup.split_batchnorm for fused
+mixup_v2 batches), since dynamo guards on it and would otherwise recompile.
+'''
+from __future__ import print_function
+
+import copy
+import time
+from contextlib import nullcontext
+
+import torch
+
+_cache = {}
+
+
+def eager_module(net):
+    '''The eager nn.Module behind a compiled (and/or DataParallel) network.'''
+    net = getattr(net, 'module', net)
+    return getattr(net, '_orig_mod', net)
+
+
+def _warmup(compiled, examples, context):
+    for example, training, example_context in examples:
+        compiled.train(training)
+        # Eval examples run in inference mode like utils.evaluate; dynamo guards on it
+        with torch.enable_grad() if training else torch.inference_mode(), context(), \
+                (example_context or nullcontext)():
+            out = compiled(example)
+        if training:
+            out.float().sum().backward()
+    compiled.train()
+
+
+def compile_model(net, mode, examples, key, context=None):
+    '''Return (network to train, seconds spent compiling) for a freshly built `net`.
+
+    `mode` is a torch.compile mode ('default', 'reduce-overhead',
+    'max-autotune') or 'none'. `examples` lists (input batch, training,
+    context factory or None) triples to warm up with, and `context` is an
+    optional context factory (e.g. autocast) all forward passes run under.
+    Training examples run with autograd, the others in inference mode.
+    '''
+    if mode == 'none':
+        return net, 0.
+    context = context or torch.enable_grad
+    key = (mode,) + tuple(key)
+    if key in _cache:
+        compiled = _cache[key]
+        eager_module(compiled).load_state_dict(net.state_dict())
+        return compiled, 0.
+
+    start = time.time()
+    state = copy.deepcopy(net.state_dict())
+    try:
+        compiled = torch.compile(net, mode=mode)
+        _warmup(compiled, examples, context)
+    except Exception as e:
+        print('torch.compile(mode=%s) failed for %s, running eager: %s'
+              % (mode, net.__class__.__name__, str(e).splitlines()[0] if str(e) else repr(e)))
+        compiled = net
+    finally:
+        # Undo the BatchNorm statistics and gradients of the synthetic batches
+        net.load_state_dict(state)
+        for p in net.parameters():
+            p.grad = None
+    _cache[key] = compiled
+    return compiled, time.time() - start
@@ -0,0 +1,416 @@
+'''Data helpers for the mixup experiments, including:
+    - pack_image_folder: decode an ImageFolder tree once into a uint8 memmap cache.
+    - PackedImageFolder: ImageFolder replacement that reads from the packed cache.
+    - image_folder: return the packed dataset when its cache exists, ImageFolder otherwise.
+    - to_uint8_hwc: PIL image -> H x W x C uint8 tensor, for batched augmentation.
+    - ResumableBatchSampler: batch sampler that can restart an epoch at a given batch.
+    - SeededBatchSampler/SeededDataset: tag every batch with a seed drawn in the main process.
+    - ShardSampler: this rank's share of an unshuffled dataset, for distributed evaluation.
+    - DataContext: datasets and loaders for one dataset, reused across trials.
+    - autotune_loader: timed sweep over loader settings on the real dataset.
+'''
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import torch
+import torch.utils.data as data
+from PIL import Image
+from torchvision.datasets import ImageFolder
+from torchvision.datasets.folder import IMG_EXTENSIONS, default_loader, find_classes, make_dataset
+
+
+def list_image_folder(root):
+    '''Scan `root` exactly like ImageFolder does and return (classes, class_to_idx, samples).'''
+    classes, class_to_idx = find_classes(root)
+    samples = make_dataset(root, class_to_idx, extensions=IMG_EXTENSIONS)
+    return classes, class_to_idx, samples
+
+
+def listing_hash(root, samples):
+    '''Hash the file listing (relative path, size, mtime) so any change invalidates the cache.'''
+    h = hashlib.sha1()
+    for path, target in samples:
+        st = os.stat(path)
+        h.update(('%s\0%d\0%d\0%d\n' % (os.path.relpath(path, root), target,
+                                        st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def cache_path(root, cache_dir, samples):
+    '''Directory holding the packed arrays for `root` with the given listing.'''
+    root = os.path.normpath(root)
+    name = '%s_%s' % (os.path.basename(os.path.dirname(root)), os.path.basename(root))
+    return os.path.join(cache_dir, '%s_%s' % (name, listing_hash(root, samples)))
+
+
+def pack_image_folder(root, cache_dir):
+    '''Decode every image under `root` into an N x H x W x C uint8 memmap plus labels.
+
+    The cache is written to a temporary directory and renamed into place, so a
+    half-written pack is never picked up. Returns the cache directory.
+    '''
+    classes, class_to_idx, samples = list_image_folder(root)
+    path = cache_path(root, cache_dir, samples)
+    if os.path.isfile(os.path.join(path, 'meta.json')):
+        return path
+    if len(samples) == 0:
+        raise ValueError('No images found under %s' % root)
+
+    first = np.asarray(default_loader(samples[0][0]))
+    shape = (len(samples),) + first.shape
+    tmp = path + '.tmp%d' % os.getpid()
+    os.makedirs(tmp)
+    try:
+        images = np.lib.format.open_memmap(os.path.join(tmp, 'images.npy'), mode='w+',
+                                           dtype=np.uint8, shape=shape)
+        labels = np.empty(len(samples), dtype=np.int64)
+        for i, (sample, target) in enumerate(samples):
+            img = np.asarray(default_loader(sample))
+            if img.shape != first.shape:
+                raise ValueError('Cannot pack %s: image %s has shape %s, expected %s'
+                                 % (root, sample, img.shape, first.shape))
+            images[i] = img
+            labels[i] = target
+        images.flush()
+        del images
+        np.save(os.path.join(tmp, 'labels.npy'), labels)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'root': root, 'classes': classes, 'class_to_idx': class_to_idx,
+                       'shape': shape}, f)
+        os.rename(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return path
+
+
+class PackedImageFolder(data.Dataset):
+    '''ImageFolder-compatible dataset backed by a packed uint8 memmap.
+
+    Images are never decoded again: `__getitem__` slices the memory map and
+    hands a PIL view to `transform`, or, when `transform` is None, returns the
+    HWC uint8 tensor sharing memory with the map. The map is opened lazily so
+    DataLoader workers each get their own handle instead of a pickled copy.
+    '''
+
+    def __init__(self, path, transform=None, target_transform=None):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.path = path
+        self.root = meta['root']
+        self.classes = meta['classes']
+        self.class_to_idx = meta['class_to_idx']
+        self.targets = np.load(os.path.join(path, 'labels.npy'))
+        self.transform = transform
+        self.target_transform = target_transform
+        self._images = None
+
+    @property
+    def images(self):
+        if self._images is None:
+            # Copy-on-write keeps slices zero-copy while giving torch a writable buffer.
+            self._images = np.load(os.path.join(self.path, 'images.npy'), mmap_mode='c')
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        img = self.images[index]
+        target = int(self.targets[index])
+        if self.transform is not None:
+            img = self.transform(Image.fromarray(img))
+        else:
+            img = torch.from_numpy(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return img, target
+
+
+def to_uint8_hwc(img):
+    '''Convert a PIL image to an H x W x C uint8 tensor without scaling.'''
+    return torch.from_numpy(np.array(img, dtype=np.uint8, copy=True))
+
+
+def image_folder(root, transform=None, cache_dir=None, raw=False):
+    '''Return a PackedImageFolder if `root` has an up-to-date cache, else an ImageFolder.
+
+    With `raw=True` samples come back as H x W x C uint8 tensors and `transform`
+    is ignored; augmentation is then left to augment.BatchAugment.
+    '''
+    if cache_dir:
+        _, _, samples = list_image_folder(root)
+        path = cache_path(root, cache_dir, samples)
+        if os.path.isfile(os.path.join(path, 'meta.json')):
+            return PackedImageFolder(path, None if raw else transform)
+    return ImageFolder(root, to_uint8_hwc if raw else transform)
+
+
+class ResumableBatchSampler(data.Sampler):
+    '''BatchSampler over `sampler` whose epochs can be replayed from any batch.
+
+    `start_state` is the state `generator` had when the current epoch started
+    drawing its shuffle. After `resume(start_state, skip)` the next epoch
+    restores that state, so it draws the same order, and leaves out its first
+    `skip` batches without loading them.
+    '''
+
+    def __init__(self, sampler, batch_size, generator=None, drop_last=False):
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.generator = generator
+        self.drop_last = drop_last
+        self.start_state = None
+        self._resume = None
+
+    def resume(self, start_state, skip):
+        self._resume = (start_state, skip)
+
+    def epoch_batches(self):
+        return iter(data.BatchSampler(self.sampler, self.batch_size, self.drop_last))
+
+    def __iter__(self):
+        skip = 0
+        if self._resume is not None:
+            (start_state, skip), self._resume = self._resume, None
+            if start_state is not None:
+                self.generator.set_state(start_state)
+        if self.generator is not None:
+            self.start_state = self.generator.get_state()
+        for i, batch in enumerate(self.epoch_batches()):
+            if i >= skip:
+                yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+
+class SeededBatchSampler(ResumableBatchSampler):
+    '''Batches of (index, seed) pairs; all samples of a batch share one seed.
+
+    Seeds come from `generator` in the main process, right after the shuffle,
+    so anything derived from them in the workers (e.g. mixup.MixupCollate) is
+    reproducible regardless of which worker handles which batch.
+    '''
+
+    def epoch_batches(self):
+        batches = list(data.BatchSampler(self.sampler, self.batch_size, self.drop_last))
+        seeds = torch.randint(2 ** 62, (len(batches),), generator=self.generator).tolist()
+        for batch, seed in zip(batches, seeds):
+            yield [(index, seed) for index in batch]
+
+
+class SeededDataset(data.Dataset):
+    '''Wrap a dataset indexed by (index, seed) pairs; samples carry the seed last.'''
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, item):
+        index, seed = item
+        return tuple(self.dataset[index]) + (seed,)
+
+
+class ShardSampler(data.Sampler):
+    '''Every `num_replicas`-th index starting at `rank`, in order.
+
+    Unlike DistributedSampler no samples are repeated to even out the shards,
+    so metrics summed over the ranks cover the dataset exactly once.
+    '''
+
+    def __init__(self, dataset, num_replicas, rank):
+        self.indices = range(rank, len(dataset), num_replicas)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class DataContext(object):
+    '''Train/test datasets and loaders for one dataset folder.
+
+    Built once per dataset and shared by every iteration and trial: the
+    directory scan happens once and the loader workers stay alive between
+    epochs and trials. Only the shuffle order changes, via `reseed`.
+
+    `train_evalset` is the training split with the test transform, for
+    evaluating on the training images without augmentation (see `eval_loader`).
+
+    With `num_replicas` > 1 the loaders only yield this `rank`'s shard: a
+    DistributedSampler for training (call `set_epoch` every epoch) and a
+    ShardSampler for evaluation.
+    '''
+
+    def __init__(self, dataset, transform_train, transform_test, batch_size,
+                 cache_dir=None, raw=False, collate_train=None, collate_test=None,
+                 seeded=False, num_workers=2, prefetch_factor=2, persistent_workers=True,
+                 pin_memory=False, eval_batch_size=8, num_replicas=1, rank=0):
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.batch_size = batch_size
+        self.collate_train = collate_train
+        self.collate_test = collate_test
+        self.seeded = seeded
+        self.trainset = image_folder(os.path.join(dataset, 'train'),
+                                     transform_train, cache_dir, raw=raw)
+        self.testset = image_folder(os.path.join(dataset, 'test'),
+                                    transform_test, cache_dir, raw=raw)
+        self.train_evalset = image_folder(os.path.join(dataset, 'train'),
+                                          transform_test, cache_dir, raw=raw)
+        # The RandomSampler draws from this generator in the main process, so
+        # reseeding it changes the shuffle without restarting the workers.
+        self.generator = torch.Generator()
+        self.configure(num_workers, prefetch_factor, persistent_workers,
+                       pin_memory, eval_batch_size)
+
+    def configure(self, num_workers, prefetch_factor=2, persistent_workers=True,
+                  pin_memory=False, eval_batch_size=None):
+        '''(Re)build both loaders with the given DataLoader settings.'''
+        self.options = {'num_workers': num_workers, 'prefetch_factor': prefetch_factor,
+                        'persistent_workers': persistent_workers, 'pin_memory': pin_memory,
+                        'eval_batch_size': eval_batch_size or self.options['eval_batch_size']}
+        self.trainloader = self.make_loader(self.trainset, self.batch_size, train=True)
+        self.testloader = self.eval_loader(self.testset)
+
+    def set_eval_batch_size(self, eval_batch_size):
+        '''Rebuild the test loader if the evaluation batch size changes.'''
+        if eval_batch_size != self.options['eval_batch_size']:
+            self.options['eval_batch_size'] = eval_batch_size
+            self.testloader = self.eval_loader(self.testset)
+
+    def make_loader(self, dataset, batch_size, train, shard=True, **overrides):
+        '''DataLoader over `dataset` using the current options, updated by `overrides`.
+
+        `shard=False` reads the whole dataset even when distributed.
+        '''
+        options = dict(self.options, **overrides)
+        workers = options['num_workers']
+        distributed = shard and self.num_replicas > 1
+        if train:
+            if distributed:
+                sampler = data.DistributedSampler(dataset, self.num_replicas, self.rank)
+            else:
+                sampler = data.RandomSampler(dataset, generator=self.generator)
+            batch_sampler = SeededBatchSampler if self.seeded else ResumableBatchSampler
+            loader_args = {'batch_sampler': batch_sampler(sampler, batch_size, self.generator)}
+            # Worker base seeds come from the generator, as with shuffle=True, and
+            # not from the global RNG, which a resumed run must draw from unchanged
+            loader_args['generator'] = self.generator
+            if self.seeded:
+                dataset = SeededDataset(dataset)
+        else:
+            loader_args = {'batch_size': batch_size, 'shuffle': False}
+            if distributed:
+                loader_args['sampler'] = ShardSampler(dataset, self.num_replicas, self.rank)
+        return data.DataLoader(dataset, num_workers=workers,
+                               prefetch_factor=options['prefetch_factor'] if workers > 0 else None,
+                               persistent_workers=options['persistent_workers'] and workers > 0,
+                               pin_memory=options['pin_memory'],
+                               collate_fn=self.collate_train if train else self.collate_test,
+                               **loader_args)
+
+    def eval_loader(self, dataset, shard=True, **overrides):
+        '''Unshuffled, unaugmented loader over `dataset` with the evaluation batch size.'''
+        return self.make_loader(dataset, self.options['eval_batch_size'], train=False,
+                                shard=shard, **overrides)
+
+    def train_sampler(self):
+        return self.trainloader.batch_sampler.sampler
+
+    def reseed(self, seed):
+        '''Set the shuffle seed for the next trial.'''
+        # Batch seeds (e.g. for loader-side mixup) differ between ranks
+        self.generator.manual_seed(seed * self.num_replicas + self.rank)
+        if isinstance(self.train_sampler(), data.DistributedSampler):
+            self.train_sampler().seed = seed
+
+    def epoch_state(self):
+        '''Shuffle generator state at the start of the current training epoch.'''
+        return self.trainloader.batch_sampler.start_state
+
+    def resume_epoch(self, start_state, skip):
+        '''Make the next training epoch repeat the one started at `start_state`, minus `skip` batches.'''
+        self.trainloader.batch_sampler.resume(start_state, skip)
+
+    def set_epoch(self, epoch):
+        '''Reshuffle the distributed shards for `epoch`; the generator-driven shuffle needs no call.'''
+        if isinstance(self.train_sampler(), data.DistributedSampler):
+            self.train_sampler().set_epoch(epoch)
+
+
+def loader_throughput(loader, batches=20):
+    '''Images/sec delivered by `loader` alone, excluding worker start-up.'''
+    it = iter(loader)
+    next(it)
+    images = 0
+    start = time.time()
+    for i, batch in enumerate(it):
+        # Count targets: batches may be mixed (5 items) and mixup_v2 inputs have 2N rows
+        images += len(batch[1])
+        if i + 1 == batches:
+            break
+    return images / max(time.time() - start, 1e-9)
+
+
+def autotune_loader(context, step_rate, workers=(0, 1, 2, 4, 8), prefetch=(2, 4),
+                    pin_memory=(False,), batches=20):
+    '''Time loader settings on `context.trainset` and configure the best one.
+
+    `step_rate` is the images/sec the model step can consume. The cheapest
+    setting (fewest workers, then smallest prefetch) whose throughput keeps
+    up with it is chosen; if none does, the fastest one is. Returns the list
+    of measured (options, images/sec) pairs and the chosen options.
+    '''
+    results = []
+    for num_workers in workers:
+        for prefetch_factor in (prefetch if num_workers > 0 else prefetch[:1]):
+            for pin in pin_memory:
+                options = {'num_workers': num_workers, 'prefetch_factor': prefetch_factor,
+                           'pin_memory': pin}
+                loader = context.make_loader(context.trainset, context.batch_size, train=True,
+                                             persistent_workers=False, **options)
+                results.append((options, loader_throughput(loader, batches)))
+                del loader
+
+    fast_enough = [r for r in results if r[1] >= step_rate]
+    if fast_enough:
+        chosen = fast_enough[0]
+    else:
+        chosen = max(results, key=lambda r: r[1])
+    context.configure(persistent_workers=context.options['persistent_workers'],
+                      eval_batch_size=context.options['eval_batch_size'], **chosen[0])
+    return results, chosen[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack ImageFolder datasets into uint8 memmaps')
+    parser.add_argument('--dataset_dir', default='Data', type=str,
+                        help='folder holding one sub-folder per dataset')
+    parser.add_argument('--cache_dir', default='cache', type=str,
+                        help='where to write the packed arrays')
+    args = parser.parse_args()
+
+    for dataset in sorted(glob.glob(args.dataset_dir + "/*")):
+        for split in ('train', 'test'):
+            root = os.path.join(dataset, split)
+            if os.path.isdir(root):
+                print('Packing', root, '->', pack_image_folder(root, args.cache_dir))
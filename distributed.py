@@ -0,0 +1,96 @@
+'''Multi-process data-parallel training with torch.distributed.
+
+train.py runs one process per rank when started by torchrun, e.g. on the
+cores of one machine:
+
+    OMP_NUM_THREADS=4 torchrun --nproc_per_node=4 train.py --workers 1 ...
+
+The process group uses gloo by default, which works on CPU (and across
+machines with torchrun's --nnodes/--rdzv options). Without torchrun's
+environment everything here is a no-op and train.py runs as one process.
+
+Each rank trains on its own shard of every epoch (DistributedSampler) and
+DistributedDataParallel averages the gradients, so --batch-size is per rank.
+Metrics are summed over the ranks with all_reduce_sum at the end of an epoch;
+only rank 0 prints, writes results and checkpoints. Checkpoints hold every
+rank's RNG states, collected with all_gather.
+'''
+from __future__ import print_function
+
+import builtins
+import os
+
+import torch
+import torch.distributed as dist
+
+rank = 0
+world_size = 1
+local_rank = 0
+
+
+def init_distributed(backend='gloo'):
+    '''Join the process group described by torchrun's environment; returns (rank, world size).'''
+    global rank, world_size, local_rank
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not dist.is_initialized():
+        dist.init_process_group(backend)
+        rank = dist.get_rank()
+        world_size = dist.get_world_size()
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        setup_for_distributed(rank == 0)
+    return rank, world_size
+
+
+def is_distributed():
+    return world_size > 1
+
+
+def is_main_process():
+    return rank == 0
+
+
+def setup_for_distributed(is_master):
+    '''Silence print() on all but the main process; print(..., force=True) still prints.'''
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if is_master or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_sum(*values):
+    '''Sum numbers or tensors over all ranks, as float64 tensors; the values themselves when not distributed.'''
+    if not is_distributed():
+        return values
+    device = next((v.device for v in values if torch.is_tensor(v)), torch.device('cpu'))
+    if device.type != 'cpu' and dist.is_initialized() and dist.get_backend() == 'gloo':
+        device = torch.device('cpu')
+    packed = torch.stack([torch.as_tensor(v, dtype=torch.float64).to(device).reshape(())
+                          for v in values])
+    dist.all_reduce(packed)
+    return packed.unbind()
+
+
+def all_gather(value):
+    '''List of `value` (any picklable object) from every rank, by rank; [value] when not distributed.'''
+    if not is_distributed():
+        return [value]
+    values = [None] * world_size
+    dist.all_gather_object(values, value)
+    return values
+
+
+def wrap_model(net):
+    '''DistributedDataParallel around `net` when running distributed, else `net` itself.'''
+    if not is_distributed():
+        return net
+    if next(net.parameters()).is_cuda:
+        return torch.nn.parallel.DistributedDataParallel(net, device_ids=[local_rank])
+    return torch.nn.parallel.DistributedDataParallel(net)
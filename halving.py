@@ -0,0 +1,66 @@
+'''Asynchronous successive halving (ASHA) over the trials of a sweep.
+
+Rungs are at min_epochs, min_epochs * eta, min_epochs * eta^2, ... epochs.
+When a trial finishes a rung epoch, its test accuracy is compared with that
+of every trial that has reached the same rung so far, and the trial only
+continues if it is among the best 1/eta of them (the best trial so far always
+continues). Decisions never wait for other trials, so the policy works the same
+for a sequential train.py run and for parallel scheduler.py jobs.
+
+Rung results are shared through an append-only CSV (one line per trial and
+rung, written in a single append), which also serves as the log of every
+decision:
+
+    trial, rung, test acc, decision, reason
+'''
+import csv
+import io
+import os
+
+
+class SuccessiveHalving(object):
+    '''Stop trials whose accuracy at a rung is below the top 1/eta of their peers.'''
+
+    def __init__(self, path, max_epochs, min_epochs=20, eta=3):
+        self.path = path
+        self.eta = eta
+        self.rungs = []
+        rung = min_epochs
+        while rung < max_epochs:
+            self.rungs.append(rung)
+            rung *= eta
+
+    def peers(self, rung):
+        '''{trial: accuracy} recorded at `rung`, the latest record per trial.'''
+        accs = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for row in csv.reader(f):
+                    if len(row) >= 3 and row[1] == str(rung):
+                        accs[row[0]] = float(row[2])
+        return accs
+
+    def report(self, trial, epoch, acc):
+        '''Record `acc` after `epoch` (0-based); returns the stop reason, or None to continue.'''
+        rung = epoch + 1
+        if rung not in self.rungs:
+            return None
+        peers = self.peers(rung)
+        peers[trial] = acc
+        ranked = sorted(peers.values(), reverse=True)
+        keep = max(1, len(ranked) // self.eta)
+        cutoff = ranked[keep - 1]
+        reason = None
+        if acc < cutoff:
+            reason = ('test acc %.3f%% at epoch %d below the top 1/%d of %d trials (cutoff %.3f%%)'
+                      % (acc, rung, self.eta, len(ranked), cutoff))
+        line = io.StringIO()
+        csv.writer(line).writerow([trial, rung, '%.6f' % acc,
+                                   'stop' if reason else 'continue', reason or ''])
+        # One append per record, so concurrent jobs do not interleave lines
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.getvalue().encode('utf-8'))
+        finally:
+            os.close(fd)
+        return reason
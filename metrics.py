@@ -0,0 +1,261 @@
+'''Per-phase timing and buffered metric logs for train.py.
+
+PhaseTimer adds up the seconds spent in each phase of training (loading data,
+forward, backward, optimizer step, evaluation, checkpointing) for the epoch
+row, and breaks every `sample_every`-th step down on its own. On the GPU,
+kernels run asynchronously, so unsampled phases only show where the host
+waited. Sampled steps synchronize the device around every phase, which makes
+their split exact at the cost of a few syncs.
+
+MetricsSink buffers records ('epoch' rows and sampled 'step' rows) in memory
+and writes them every `flush_seconds`, on `flush` and on `close`, in one or more
+formats:
+
+    csv          <path>.csv (epochs) and <path>_steps.csv; an existing file
+                 keeps its header
+    jsonl        <path>.jsonl, one {"kind", "step", "time", ...} object per record
+    tensorboard  <dir>/tb/<name>/events.out.tfevents.*, scalars tagged
+                 <kind>/<column_name>; written without the tensorboard package
+'''
+import csv
+import json
+import os
+import socket
+import struct
+import time
+from contextlib import contextmanager
+
+PHASES = ('data', 'forward', 'backward', 'step', 'eval', 'checkpoint')
+FORMATS = ('csv', 'jsonl', 'tensorboard')
+
+
+class PhaseTimer(object):
+    '''Seconds per phase since the last `reset`, and per sampled step.'''
+
+    def __init__(self, phases=PHASES, sample_every=0, sync=None):
+        self.phases = phases
+        self.sample_every = sample_every
+        self.sync = sync
+        self.totals = dict.fromkeys(phases, 0.)
+        self.sample = None
+
+    def start_step(self, step):
+        '''Begin step `step` of an epoch; it is broken down if it is a sampled one.'''
+        if self.sample_every and step % self.sample_every == 0:
+            self.sample = dict.fromkeys(self.phases, 0.)
+        else:
+            self.sample = None
+
+    def end_step(self):
+        '''The phase seconds of the step if it was sampled, else None.'''
+        sample, self.sample = self.sample, None
+        return sample
+
+    @contextmanager
+    def phase(self, name):
+        if self.sample is not None and self.sync is not None:
+            self.sync()
+        start = time.time()
+        try:
+            yield
+        finally:
+            if self.sample is not None and self.sync is not None:
+                self.sync()
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds):
+        self.totals[name] += seconds
+        if self.sample is not None:
+            self.sample[name] += seconds
+
+    def reset(self):
+        '''Return the totals so far and start new ones.'''
+        totals, self.totals = self.totals, dict.fromkeys(self.phases, 0.)
+        return totals
+
+
+def phase_columns(seconds):
+    '''{'<phase> time': seconds} columns for a PhaseTimer breakdown.'''
+    return dict(('%s time' % name, value) for name, value in seconds.items())
+
+
+class MetricsSink(object):
+    '''Buffered writer of metric records; see the module docstring for the formats.'''
+
+    def __init__(self, path, formats=('csv',), flush_seconds=30.):
+        self.flush_seconds = flush_seconds
+        self.outputs = []
+        for fmt in formats:
+            if fmt == 'csv':
+                self.outputs.append(CSVOutput(path))
+            elif fmt == 'jsonl':
+                self.outputs.append(JSONLinesOutput(path + '.jsonl'))
+            elif fmt == 'tensorboard':
+                self.outputs.append(EventFileOutput(os.path.join(
+                    os.path.dirname(path), 'tb', os.path.basename(path))))
+            else:
+                raise ValueError('unknown metrics format %r' % fmt)
+        self.buffer = []
+        self.last_flush = time.time()
+
+    def write(self, kind, step, record):
+        '''Queue `record` (column -> value) of `kind` ('epoch' or 'step') at `step`.'''
+        self.buffer.append((kind, step, time.time(), record))
+        if time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        records, self.buffer = self.buffer, []
+        for output in self.outputs:
+            output.write(records)
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        for output in self.outputs:
+            output.close()
+
+
+class CSVOutput(object):
+    ''''epoch' records go to <path>.csv, other kinds to <path>_<kind>s.csv.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+
+    def writer(self, kind, record):
+        if kind not in self.files:
+            name = self.path + ('.csv' if kind == 'epoch' else '_%ss.csv' % kind)
+            fields = None
+            if os.path.exists(name) and os.path.getsize(name) > 0:
+                # Appending to an earlier run's log: keep its columns
+                with open(name) as f:
+                    fields = next(csv.reader(f))
+            f = open(name, 'a')
+            writer = csv.DictWriter(f, fields or list(record), restval='', extrasaction='ignore')
+            if fields is None:
+                writer.writeheader()
+            self.files[kind] = (f, writer)
+        return self.files[kind][1]
+
+    def write(self, records):
+        for kind, step, wall_time, record in records:
+            self.writer(kind, record).writerow(record)
+        for f, _ in self.files.values():
+            f.flush()
+
+    def close(self):
+        for f, _ in self.files.values():
+            f.close()
+        self.files = {}
+
+
+class JSONLinesOutput(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def write(self, records):
+        if not records:
+            return
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(''.join(json.dumps(dict([('kind', kind), ('step', step), ('time', round(wall_time, 3))]
+                                                + list(record.items()))) + '\n'
+                                for kind, step, wall_time, record in records))
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class EventFileOutput(object):
+    '''TensorBoard event file: TFRecords of Event protos holding simple_value scalars.'''
+
+    def __init__(self, logdir):
+        self.logdir = logdir
+        self.file = None
+
+    def write(self, records):
+        if not records:
+            return
+        if self.file is None:
+            os.makedirs(self.logdir, exist_ok=True)
+            self.file = open(os.path.join(self.logdir, 'events.out.tfevents.%d.%s'
+                                          % (time.time(), socket.gethostname())), 'ab')
+            self.file.write(tfrecord(event(time.time(), 0, file_version='brain.Event:2')))
+        for kind, step, wall_time, record in records:
+            values = [('%s/%s' % (kind, column.replace(' ', '_')), float(value))
+                      for column, value in record.items()
+                      if isinstance(value, (int, float)) and not isinstance(value, bool)]
+            if values:
+                self.file.write(tfrecord(event(wall_time, step, values=values)))
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# Just enough protobuf and TFRecord encoding for scalar summaries:
+#   Event {1: double wall_time, 2: int64 step, 3: string file_version, 5: Summary summary}
+#   Summary {1: repeated Value value}, Value {1: string tag, 2: float simple_value}
+def varint(n):
+    out = bytearray()
+    while True:
+        byte, n = n & 0x7f, n >> 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def field(number, wire_type, payload):
+    if wire_type == 2:
+        payload = varint(len(payload)) + payload
+    return varint(number << 3 | wire_type) + payload
+
+
+def event(wall_time, step, file_version=None, values=()):
+    proto = field(1, 1, struct.pack('<d', wall_time)) + field(2, 0, varint(step))
+    if file_version is not None:
+        proto += field(3, 2, file_version.encode('utf-8'))
+    if values:
+        summary = b''.join(field(1, 2, field(1, 2, tag.encode('utf-8')) + field(2, 5, struct.pack('<f', value)))
+                           for tag, value in values)
+        proto += field(5, 2, summary)
+    return proto
+
+
+def _crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82f63b78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+CRC32C_TABLE = _crc32c_table()
+
+
+def crc32c(data):
+    crc = 0xffffffff
+    for byte in bytearray(data):
+        crc = CRC32C_TABLE[(crc ^ byte) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+
+def masked_crc32c(data):
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xffffffff
+
+
+def tfrecord(data):
+    length = struct.pack('<Q', len(data))
+    return length + struct.pack('<I', masked_crc32c(length)) + data + struct.pack('<I', masked_crc32c(data))
@@ -0,0 +1,293 @@
+'''Vectorized batch mixing.
+
+Every mixing strategy (mixup, CutMix, and switching between them per batch or
+per sample) is expressed the same way: a permutation `index`, a weight map
+`weight` broadcastable to the batch giving the share of each sample that is
+kept, and an N-vector `lam` with the share of the label that is kept. Mixing
+is then one kernel into a buffer that is allocated once and reused:
+
+    buffer <- x[index]                        (index_select into the buffer)
+    buffer <- buffer + weight * (x - buffer)  (in-place lerp)
+
+For mixup `weight` is lam per sample; for CutMix it is a 0/1 box mask. Random
+draws are vectorized numpy calls on the strategy's own Generator, so the hot
+path has no per-sample Python. `lam` doubles as the soft-target weight of
+`y_a` (and `1 - lam` of `y_b`) for the criterion and the accuracy.
+
+Strategies register themselves in MIXERS under the name used by --mix and
+time their own calls, see Mixer.cost.
+
+MixupCollate moves the mixing into the DataLoader workers: batches arrive
+already mixed, with the permutation and lambdas drawn from a per-batch seed
+that the main process hands out (see data.SeededBatchSampler), so results do
+not depend on the number of workers or their scheduling.
+
+MixupCrossEntropy computes the mixup loss from a single log-softmax, gathering
+the `y_a` and `y_b` columns (or taking a dense soft-target matrix for
+per-sample or multi-way mixing) instead of evaluating CrossEntropyLoss twice.
+
+split_batchnorm lets mixup_v2 run its clean and mixed batches through one
+forward pass while every BatchNorm2d still normalizes each half with its own
+statistics, matching the two separate passes.
+'''
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+
+MIXERS = {}
+
+
+def empty_rows(x, rows):
+    '''Uninitialized tensor like `x` but with `rows` rows, keeping a channels_last layout.'''
+    channels_last = (x.dim() == 4 and not x.is_contiguous()
+                     and x.is_contiguous(memory_format=torch.channels_last))
+    return torch.empty((rows,) + x.shape[1:], dtype=x.dtype, device=x.device,
+                       memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+
+
+def register_mixer(name):
+    '''Class decorator adding a Mixer subclass to MIXERS under `name`.'''
+    def register(cls):
+        cls.name = name
+        MIXERS[name] = cls
+        return cls
+    return register
+
+
+def build_mixer(name, alpha=1.0, per_sample=False, seed=None):
+    return MIXERS[name](alpha, per_sample=per_sample, seed=seed)
+
+
+class Mixer(object):
+    '''Base class of the mixing strategies.
+
+    Calling a mixer returns (mixed_x, y_a, y_b, lam) for a batch (x, y).
+    Subclasses only implement `weights`.
+    '''
+    name = None
+
+    def __init__(self, alpha=1.0, per_sample=False, seed=None):
+        self.alpha = alpha
+        self.per_sample = per_sample
+        self.rng = np.random.default_rng(seed)
+        self._buffer = None
+        self.reset_cost()
+
+    def reseed(self, seed):
+        '''Restart the mixer's own random stream from `seed` (an int or a list of ints).'''
+        self.rng = np.random.default_rng(seed)
+
+    def sample_lam(self, n, rng):
+        '''Beta(alpha, alpha) draws as an N-vector: one per sample or one shared.'''
+        if self.alpha <= 0:
+            return np.ones(n)
+        lam = rng.beta(self.alpha, self.alpha, n if self.per_sample else 1)
+        return np.broadcast_to(lam, (n,))
+
+    def weights(self, shape, rng):
+        '''(weight, lam) for a batch of `shape`; weight is broadcastable to it.'''
+        raise NotImplementedError
+
+    def draw(self, shape, rng=None):
+        '''(index, weight, lam) CPU tensors for a batch of `shape`.
+
+        `rng` may be a numpy Generator or a seed; by default the mixer's own
+        Generator is used.
+        '''
+        if rng is None:
+            rng = self.rng
+        elif not isinstance(rng, np.random.Generator):
+            rng = np.random.default_rng(rng)
+        index = torch.from_numpy(rng.permutation(shape[0]))
+        weight, lam = self.weights(shape, rng)
+        return index, weight, torch.from_numpy(np.ascontiguousarray(lam, dtype=np.float32))
+
+    def buffer(self, x):
+        '''Reusable output buffer shaped like `x`.'''
+        buf = self._buffer
+        if (buf is None or buf.shape != x.shape or buf.dtype != x.dtype
+                or buf.device != x.device or buf.stride() != x.stride()):
+            buf = self._buffer = torch.empty_like(x)
+        return buf
+
+    def __call__(self, x, y, draw=None, out=None):
+        start = time.perf_counter()
+        index, weight, lam = draw if draw is not None else self.draw(x.shape)
+        index = index.to(x.device)
+        weight = weight.to(device=x.device, dtype=x.dtype)
+        lam = lam.to(x.device)
+        if x.requires_grad:
+            # Hidden activations: keep autograd happy and skip the buffer.
+            mixed_x = torch.lerp(x[index], x, weight)
+        else:
+            if out is None:
+                out = self.buffer(x)
+            mixed_x = torch.index_select(x, 0, index, out=out)
+            mixed_x.lerp_(x, weight)
+        result = mixed_x, y, y[index], lam
+        self.seconds += time.perf_counter() - start
+        self.calls += 1
+        return result
+
+    def cost(self):
+        '''Mean milliseconds per call since the last reset (host time, kernels are async on GPU).'''
+        return 1e3 * self.seconds / max(self.calls, 1)
+
+    def reset_cost(self):
+        self.seconds = 0.
+        self.calls = 0
+
+
+@register_mixer('mixup')
+class Mixup(Mixer):
+    '''Convex combination of sample pairs, x = lam * x_i + (1 - lam) * x_j.'''
+
+    def weights(self, shape, rng):
+        lam = self.sample_lam(shape[0], rng)
+        weight = torch.from_numpy(np.ascontiguousarray(lam, dtype=np.float32))
+        return weight.view((shape[0],) + (1,) * (len(shape) - 1)), lam
+
+
+@register_mixer('cutmix')
+class CutMix(Mixer):
+    '''Paste a box of the paired sample, box area 1 - lam (Yun et al., 2019).
+
+    One box for the batch, or one per sample with `per_sample`. `lam` is
+    corrected to the kept area after the box is clipped to the image.
+    '''
+
+    def weights(self, shape, rng):
+        n = shape[0]
+        h, w = shape[-2:]
+        m = n if self.per_sample else 1
+        cut = np.sqrt(1. - self.sample_lam(m, rng))
+        cy = rng.integers(0, h, m)
+        cx = rng.integers(0, w, m)
+        half_h = (h * cut).astype(np.int64) // 2
+        half_w = (w * cut).astype(np.int64) // 2
+        y1, y2 = np.clip(cy - half_h, 0, h), np.clip(cy + half_h, 0, h)
+        x1, x2 = np.clip(cx - half_w, 0, w), np.clip(cx + half_w, 0, w)
+        lam = np.broadcast_to(1. - (y2 - y1) * (x2 - x1) / float(h * w), (n,))
+
+        rows = torch.arange(h).view(1, h, 1)
+        cols = torch.arange(w).view(1, 1, w)
+        box = lambda a: torch.from_numpy(a).view(m, 1, 1)
+        inside = ((rows >= box(y1)) & (rows < box(y2))
+                  & (cols >= box(x1)) & (cols < box(x2)))
+        weight = (~inside).float().unsqueeze(1).expand(n, 1, h, w)
+        return weight, lam
+
+
+@register_mixer('switch')
+class SwitchMix(Mixer):
+    '''Mixup or CutMix for the whole batch, chosen with probability 1/2 each step.'''
+
+    def __init__(self, alpha=1.0, per_sample=False, seed=None):
+        super(SwitchMix, self).__init__(alpha, per_sample, seed)
+        self.choices = [Mixup(alpha, per_sample), CutMix(alpha, per_sample)]
+
+    def weights(self, shape, rng):
+        return self.choices[int(rng.random() < 0.5)].weights(shape, rng)
+
+
+@register_mixer('per_sample_switch')
+class PerSampleSwitchMix(SwitchMix):
+    '''Mixup or CutMix chosen independently for every sample of the batch.'''
+
+    def weights(self, shape, rng):
+        (mix_weight, mix_lam), (cut_weight, cut_lam) = [c.weights(shape, rng) for c in self.choices]
+        use_cut = rng.random(shape[0]) < 0.5
+        lam = np.where(use_cut, cut_lam, mix_lam)
+        which = torch.from_numpy(use_cut).view((shape[0],) + (1,) * (len(shape) - 1))
+        return torch.where(which, cut_weight, mix_weight), lam
+
+
+class MixupCollate(object):
+    '''collate_fn returning already mixed batches (inputs, targets, y_a, y_b, lam).
+
+    Expects samples tagged with their batch seed by data.SeededDataset. With
+    `include_clean` (mixup_v2) `inputs` holds 2N rows: the clean batch followed
+    by the mixed one. A fresh output tensor is used for every batch because
+    worker batches are shared with the main process, not copied.
+    '''
+
+    def __init__(self, mixer, collate=None, include_clean=False):
+        self.mixer = mixer
+        self.collate = collate or default_collate
+        self.include_clean = include_clean
+
+    def __call__(self, batch):
+        seed = batch[0][-1]
+        inputs, targets = self.collate([sample[:-1] for sample in batch])
+        n = inputs.size(0)
+        draw = self.mixer.draw(inputs.shape, seed)
+        if self.include_clean:
+            out = empty_rows(inputs, 2 * n)
+            out[:n] = inputs
+            _, targets_a, targets_b, lam = self.mixer(inputs, targets, draw, out=out[n:])
+            return out, targets, targets_a, targets_b, lam
+        mixed, targets_a, targets_b, lam = self.mixer(inputs, targets, draw,
+                                                      out=torch.empty_like(inputs))
+        return mixed, targets, targets_a, targets_b, lam
+
+
+class MixupCrossEntropy(nn.Module):
+    '''Cross-entropy against mixed targets with one log-softmax.
+
+    criterion(pred, y_a, y_b, lam) == mean(lam * CE(pred, y_a) + (1 - lam) * CE(pred, y_b)),
+    with `lam` a float or an N-vector. criterion(pred, y) is plain cross-entropy
+    for class indices, and soft-target cross-entropy when `y` is an N x C matrix.
+    '''
+
+    def forward(self, pred, y_a, y_b=None, lam=None):
+        logp = F.log_softmax(pred, 1, dtype=torch.float32)
+        if y_a.dim() == 2:
+            return -(y_a * logp).sum(1).mean()
+        logp_a = logp.gather(1, y_a.unsqueeze(1)).squeeze(1)
+        if y_b is None:
+            return -logp_a.mean()
+        logp_b = logp.gather(1, y_b.unsqueeze(1)).squeeze(1)
+        if torch.is_tensor(lam):
+            lam = lam.float()
+        return -torch.lerp(logp_b, logp_a, lam).mean()
+
+
+class _SplitBatchNorm2d(nn.BatchNorm2d):
+    '''BatchNorm2d that normalizes `groups` equal chunks of the batch separately.
+
+    Chunks are processed in order, so batch statistics and running-stat
+    updates are exactly those of one forward pass per chunk.
+    '''
+    groups = 2
+
+    def forward(self, x):
+        if not self.training:
+            return super(_SplitBatchNorm2d, self).forward(x)
+        return torch.cat([super(_SplitBatchNorm2d, self).forward(chunk)
+                          for chunk in x.chunk(self.groups)])
+
+
+@contextmanager
+def split_batchnorm(net, groups=2):
+    '''Within the block, every BatchNorm2d of `net` uses per-chunk statistics.
+
+    `groups=1` leaves the network untouched (statistics shared by the whole batch).
+    '''
+    swapped = []
+    if groups > 1:
+        for m in net.modules():
+            if type(m) is nn.BatchNorm2d:
+                m.__class__ = _SplitBatchNorm2d
+                m.groups = groups
+                swapped.append(m)
+    try:
+        yield net
+    finally:
+        for m in swapped:
+            m.__class__ = nn.BatchNorm2d
+            del m.groups
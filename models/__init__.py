@@ -1,3 +1,4 @@
+from .staged import Staged, num_stages
 from .vgg import *
 from .lenet import *
 from .resnet import *
@@ -22,7 +22,7 @@ class AllDNet(nn.Module):
         out = F.relu(self.conv2(out))
         # out = out.view(out.size(0), 16, 10, -1)
         out = F.max_pool2d(out, 2)
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), -1)
         activations.append(out)
         out = F.relu(self.fc1(out))
         activations.append(out)
@@ -7,6 +7,8 @@ import torch.nn.functional as F
 
 from torch.autograd import Variable
 
+from .staged import Staged
+
 
 class Bottleneck(nn.Module):
     def __init__(self, in_planes, growth_rate):
@@ -35,7 +37,7 @@ class Transition(nn.Module):
         return out
 
 
-class DenseNet(nn.Module):
+class DenseNet(Staged):
     def __init__(self, block, nblocks, growth_rate=12, reduction=0.5, num_classes=10):
         super(DenseNet, self).__init__()
         self.growth_rate = growth_rate
@@ -74,16 +76,18 @@ class DenseNet(nn.Module):
             in_planes += self.growth_rate
         return nn.Sequential(*layers)
 
-    def forward(self, x):
-        out = self.conv1(x)
-        out = self.trans1(self.dense1(out))
-        out = self.trans2(self.dense2(out))
-        out = self.trans3(self.dense3(out))
-        out = self.dense4(out)
-        out = F.avg_pool2d(F.relu(self.bn(out)), 4)
+    def stages(self):
+        return [self.conv1,
+                lambda out: self.trans1(self.dense1(out)),
+                lambda out: self.trans2(self.dense2(out)),
+                lambda out: self.trans3(self.dense3(out)),
+                self.dense4,
+                self._head]
+
+    def _head(self, x):
+        out = F.avg_pool2d(F.relu(self.bn(x)), 4)
         out = out.view(out.size(0), -1)
-        out = self.linear(out)
-        return out
+        return self.linear(out)
 
 def DenseNet121():
     return DenseNet(Bottleneck, [6,12,24,16], growth_rate=32)
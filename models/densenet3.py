@@ -3,6 +3,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .staged import Staged
+
 
 class BasicBlock(nn.Module):
     def __init__(self, in_planes, out_planes, dropRate=0.0):
@@ -65,7 +67,7 @@ class DenseBlock(nn.Module):
     def forward(self, x):
         return self.layer(x)
 
-class DenseNet3(nn.Module):
+class DenseNet3(Staged):
     def __init__(self, depth, num_classes, growth_rate=12,
                  reduction=0.5, bottleneck=True, dropRate=0.0):
         super(DenseNet3, self).__init__()
@@ -107,12 +109,15 @@ class DenseNet3(nn.Module):
                 m.bias.data.zero_()
             elif isinstance(m, nn.Linear):
                 m.bias.data.zero_()
-    def forward(self, x):
-        out = self.conv1(x)
-        out = self.trans1(self.block1(out))
-        out = self.trans2(self.block2(out))
-        out = self.block3(out)
-        out = self.relu(self.bn1(out))
+    def stages(self):
+        return [self.conv1,
+                lambda out: self.trans1(self.block1(out)),
+                lambda out: self.trans2(self.block2(out)),
+                self.block3,
+                self._head]
+
+    def _head(self, x):
+        out = self.relu(self.bn1(x))
         out = F.avg_pool2d(out, 8)
         out = out.view(-1, self.in_planes)
         return self.fc(out)
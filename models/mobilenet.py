@@ -9,6 +9,8 @@ import torch.nn.functional as F
 
 from torch.autograd import Variable
 
+from .staged import Staged
+
 
 class Block(nn.Module):
     '''Depthwise conv + Pointwise conv'''
@@ -25,7 +27,7 @@ class Block(nn.Module):
         return out
 
 
-class MobileNet(nn.Module):
+class MobileNet(Staged):
     # (128,2) means conv planes=128, conv stride=2, by default conv stride=1
     cfg = [64, (128,2), 128, (256,2), 256, (512,2), 512, 512, 512, 512, 512, (1024,2), 1024]
 
@@ -45,13 +47,20 @@ class MobileNet(nn.Module):
             in_planes = out_planes
         return nn.Sequential(*layers)
 
-    def forward(self, x):
-        out = F.relu(self.bn1(self.conv1(x)))
-        out = self.layers(out)
-        out = F.avg_pool2d(out, 2)
+    def stages(self):
+        # One stage per resolution: split the blocks before every stride-2 block
+        bounds = [0] + [i for i, x in enumerate(self.cfg) if not isinstance(x, int)] + [len(self.cfg)]
+        return ([self._stem]
+                + [self.layers[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+                + [self._head])
+
+    def _stem(self, x):
+        return F.relu(self.bn1(self.conv1(x)))
+
+    def _head(self, x):
+        out = F.avg_pool2d(x, 2)
         out = out.view(out.size(0), -1)
-        out = self.linear(out)
-        return out
+        return self.linear(out)
 
 
 def test():
@@ -14,6 +14,8 @@ import torch.nn.functional as F
 
 from torch.autograd import Variable
 
+from .staged import Staged
+
 
 def conv3x3(in_planes, out_planes, stride=1):
     return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride, padding=1, bias=False)
@@ -127,7 +129,7 @@ class PreActBottleneck(nn.Module):
         return out
 
 
-class ResNet(nn.Module):
+class ResNet(Staged):
     def __init__(self, block, num_blocks, num_classes=10):
         super(ResNet, self).__init__()
         self.in_planes = 64
@@ -148,25 +150,16 @@ class ResNet(nn.Module):
             self.in_planes = planes * block.expansion
         return nn.Sequential(*layers)
 
-    def forward(self, x, lin=0, lout=5):
-        out = x
-        if lin < 1 and lout > -1:
-            out = self.conv1(out)
-            out = self.bn1(out)
-            out = F.relu(out)
-        if lin < 2 and lout > 0:
-            out = self.layer1(out)
-        if lin < 3 and lout > 1:
-            out = self.layer2(out)
-        if lin < 4 and lout > 2:
-            out = self.layer3(out)
-        if lin < 5 and lout > 3:
-            out = self.layer4(out)
-        if lout > 4:
-            out = F.avg_pool2d(out, 4)
-            out = out.view(out.size(0), -1)
-            out = self.linear(out)
-        return out
+    def stages(self):
+        return [self._stem, self.layer1, self.layer2, self.layer3, self.layer4, self._head]
+
+    def _stem(self, x):
+        return F.relu(self.bn1(self.conv1(x)))
+
+    def _head(self, x):
+        out = F.avg_pool2d(x, 4)
+        out = out.view(out.size(0), -1)
+        return self.linear(out)
 
 
 def ResNet18(num_classes):
@@ -8,6 +8,8 @@ import torch.nn.functional as F
 
 from torch.autograd import Variable
 
+from .staged import Staged
+
 
 class Block(nn.Module):
     '''Grouped convolution block.'''
@@ -39,7 +41,7 @@ class Block(nn.Module):
         return out
 
 
-class ResNeXt(nn.Module):
+class ResNeXt(Staged):
     def __init__(self, num_blocks, cardinality, bottleneck_width, num_classes=10):
         super(ResNeXt, self).__init__()
         self.cardinality = cardinality
@@ -64,16 +66,17 @@ class ResNeXt(nn.Module):
         self.bottleneck_width *= 2
         return nn.Sequential(*layers)
 
-    def forward(self, x):
-        out = F.relu(self.bn1(self.conv1(x)))
-        out = self.layer1(out)
-        out = self.layer2(out)
-        out = self.layer3(out)
-        # out = self.layer4(out)
-        out = F.avg_pool2d(out, 8)
+    def stages(self):
+        # self.layer4 is disabled, see __init__
+        return [self._stem, self.layer1, self.layer2, self.layer3, self._head]
+
+    def _stem(self, x):
+        return F.relu(self.bn1(self.conv1(x)))
+
+    def _head(self, x):
+        out = F.avg_pool2d(x, 8)
         out = out.view(out.size(0), -1)
-        out = self.linear(out)
-        return out
+        return self.linear(out)
 
 
 def ResNeXt29_2x64d():
@@ -0,0 +1,36 @@
+'''Common interface for models that run as a sequence of stages.
+
+A staged model lists its stages in `stages()`; the last one is the classifier
+head. `forward(x, lin, lout)` runs stages lin..lout inclusive, so a network
+can be run up to a stage, the activations changed (e.g. by manifold mixup),
+and the rest run from there without recomputing the prefix:
+
+    hidden = net(x, lout=k - 1)
+    outputs = net(hidden, lin=k)
+
+`lout=-1` returns the input unchanged.
+'''
+import torch.nn as nn
+
+
+class Staged(nn.Module):
+    def stages(self):
+        raise NotImplementedError
+
+    def forward(self, x, lin=0, lout=None):
+        stages = self.stages()
+        if lout is None:
+            lout = len(stages) - 1
+        out = x
+        for stage in stages[max(lin, 0):lout + 1]:
+            out = stage(out)
+        return out
+
+
+def num_stages(net):
+    '''Number of stages of `net`, looking through DataParallel and torch.compile wrappers; 0 if not staged.'''
+    net = getattr(net, 'module', net)
+    net = getattr(net, '_orig_mod', net)
+    if not isinstance(net, Staged):
+        return 0
+    return len(net.stages())
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3 -u
+'''Run the dataset x iteration x trial grid of train.py as parallel jobs.
+
+    python scheduler.py [--max-jobs N] [--threads-per-job T] [--no-pin] [train.py arguments]
+
+Every (dataset, iteration, trial) cell that train.py would run in sequence
+becomes its own `train.py --job DATASET ITERATION TRIAL` process, so the
+results_*/ CSV logs, checkpoint/ files and <dataset>_.txt reports end up at
+the same paths as a sequential run. At most --max-jobs jobs run at once, each
+in a slot of --threads-per-job cores: the job is pinned to those cores
+(taskset, or sched_setaffinity on the new process) and its OpenMP/MKL thread pools are sized to match, so
+concurrent jobs do not oversubscribe the machine. Loader workers inherit the
+pinning; --workers 0 or 1 is usually the right setting for small models.
+
+Every trial is seeded from (--seed, iteration, trial): shuffle, weight init
+and mixing. So a job matches the same trial of a sequential run, and its
+result does not depend on the schedule. Augmentation in persistent loader
+workers is the exception: a sequential run keeps those workers, and their
+random streams, from one trial to the next; compare with --workers 0 or
+--no-persistent-workers. Job output goes to
+results_<dataset>/job_<iteration>_<trial>_<name>_<seed>.out, and a summary
+with per-job times and the aggregate throughput is printed at the end and
+written to scheduler_<name>_<seed>.csv.
+'''
+from __future__ import print_function
+
+import argparse
+import csv
+import glob
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from data import list_image_folder, pack_image_folder
+
+TRAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def core_slots(cores, threads_per_job, max_jobs=None):
+    '''Core sets of `threads_per_job` cores for each concurrent job.
+
+    By default as many disjoint slots as fit; more jobs than that share cores
+    round-robin.
+    '''
+    if max_jobs is None:
+        max_jobs = max(1, len(cores) // threads_per_job)
+    return [sorted(set(cores[(i * threads_per_job + k) % len(cores)] for k in range(threads_per_job)))
+            for i in range(max_jobs)]
+
+
+def grid(dataset_dir, iterations, trials):
+    '''(dataset path, iteration, trial) jobs in train.py's sequential order.'''
+    return [(dataset, iteration, trial)
+            for dataset in sorted(glob.glob(dataset_dir + "/*"))
+            for iteration in range(iterations)
+            for trial in range(trials)]
+
+
+def run_job(job, cores, threads, train_args, output, pin=True):
+    '''Run one train.py job with `threads` threads pinned to `cores`; returns (seconds, exit code).'''
+    dataset, iteration, trial = job
+    threads = str(threads)
+    env = dict(os.environ, OMP_NUM_THREADS=threads, MKL_NUM_THREADS=threads)
+    command = ([sys.executable, TRAIN, '--job', dataset.split("/")[-1], str(iteration), str(trial)]
+               + train_args)
+    # Pin without a preexec_fn, which is not safe to run from the scheduler's threads
+    taskset = pin and shutil.which('taskset')
+    if taskset:
+        command = [taskset, '-c', ','.join(map(str, cores))] + command
+    start = time.time()
+    with open(output, 'w') as out:
+        proc = subprocess.Popen(command, stdout=out, stderr=subprocess.STDOUT, env=env)
+        if pin and not taskset and hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(proc.pid, cores)
+            except OSError:
+                pass  # the job already exited
+        code = proc.wait()
+    return time.time() - start, code
+
+
+def busy_core_seconds(intervals):
+    '''Core-seconds during which each core ran at least one job, from (cores, start, end) intervals.
+
+    Jobs sharing a core (more --max-jobs than disjoint slots) count it once.
+    '''
+    busy = 0.
+    for core in set(core for cores, _, _ in intervals for core in cores):
+        end = None
+        for start, stop in sorted((start, stop) for cores, start, stop in intervals if core in cores):
+            if end is not None and start < end:
+                start = end
+            if stop > start:
+                busy += stop - start
+                end = stop if end is None else max(end, stop)
+    return busy
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the train.py experiment grid as parallel jobs; '
+                    'unrecognized arguments are passed to train.py')
+    parser.add_argument('--max-jobs', default=None, type=int,
+                        help='concurrent jobs (default: available cores // --threads-per-job)')
+    parser.add_argument('--threads-per-job', default=1, type=int,
+                        help='cores and intra-op threads given to each job')
+    parser.add_argument('--no-pin', dest='pin', action='store_false',
+                        help='only limit threads, do not pin jobs to cores')
+    args, train_args = parser.parse_known_args()
+    train_args = [a for a in train_args if a != '--']
+
+    # The train.py options that define the grid and the output paths
+    grid_parser = argparse.ArgumentParser(add_help=False)
+    grid_parser.add_argument('--dataset_dir', default='Data')
+    grid_parser.add_argument('--iterations', default=2, type=int)
+    grid_parser.add_argument('--trials', default=5, type=int)
+    grid_parser.add_argument('--epoch', default=200, type=int)
+    grid_parser.add_argument('--name', default='0')
+    grid_parser.add_argument('--seed', default=0, type=int)
+    grid_parser.add_argument('--cache_dir', default='cache')
+    grid_parser.add_argument('--pack', action='store_true')
+    grid_parser.add_argument('--job', nargs=3)
+    grid_parser.add_argument('--progress')
+    train, _ = grid_parser.parse_known_args(train_args)
+    if train.job:
+        parser.error('--job is chosen by the scheduler')
+
+    jobs = grid(train.dataset_dir, train.iterations, train.trials)
+    if not jobs:
+        sys.exit('ERROR: no datasets in %s' % train.dataset_dir)
+    datasets = sorted(set(job[0] for job in jobs))
+
+    if train.pack:
+        # Pack once here instead of in every job
+        for dataset in datasets:
+            for split in ('train', 'test'):
+                print('Packing', split, 'split ->',
+                      pack_image_folder(os.path.join(dataset, split), train.cache_dir))
+        train_args = [a for a in train_args if a != '--pack']
+    if train.progress is None:
+        train_args += ['--progress', 'log']
+
+    train_images = {dataset: len(list_image_folder(os.path.join(dataset, 'train'))[2])
+                    for dataset in datasets}
+    for dataset in datasets:
+        os.makedirs('results_' + dataset.split("/")[-1], exist_ok=True)
+
+    slots = core_slots(available_cores(), args.threads_per_job, args.max_jobs)
+    free = queue.Queue()
+    for cores in slots:
+        free.put(cores)
+
+    def run(job):
+        cores = free.get()
+        try:
+            dataset, iteration, trial = job
+            output = ('results_%s/job_%d_%d_%s_%d.out'
+                      % (dataset.split("/")[-1], iteration, trial, train.name, train.seed))
+            began = time.time()
+            return cores, began, run_job(job, cores, args.threads_per_job, train_args, output, args.pin)
+        finally:
+            free.put(cores)
+
+    print('Running %d jobs, %d at a time with %d threads each'
+          % (len(jobs), len(slots), args.threads_per_job))
+    start = time.time()
+    finished = []
+    intervals = []
+    with ThreadPoolExecutor(max_workers=len(slots)) as pool:
+        futures = {pool.submit(run, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            cores, began, (seconds, code) = future.result()
+            finished.append((job, cores, seconds, code))
+            intervals.append((cores, began, began + seconds))
+            print('[%d/%d] %s iteration %d trial %d: %.1fs on cores %s%s'
+                  % (len(finished), len(jobs), job[0].split("/")[-1], job[1], job[2], seconds,
+                     ','.join(map(str, cores)), '' if code == 0 else ' FAILED (exit %d)' % code))
+    wall = time.time() - start
+
+    done = [f for f in finished if f[3] == 0]
+    images = sum(train_images[job[0]] * train.epoch for job, _, _, _ in done)
+    busy = busy_core_seconds(intervals)
+    used_cores = len(set(core for cores in slots for core in cores))
+    print('%d/%d jobs in %.1fs | %.1f jobs/hour | %.1f train img/s | core utilization %.0f%%'
+          % (len(done), len(jobs), wall, 3600. * len(done) / wall, images / wall,
+             100. * busy / (wall * used_cores)))
+
+    logname = 'scheduler_' + train.name + '_' + str(train.seed) + '.csv'
+    with open(logname, 'w') as logfile:
+        logwriter = csv.writer(logfile, delimiter=',')
+        logwriter.writerow(['dataset', 'iteration', 'trial', 'cores', 'seconds', 'exit code'])
+        for job, cores, seconds, code in sorted(finished):
+            logwriter.writerow([job[0].split("/")[-1], job[1], job[2], ' '.join(map(str, cores)),
+                                '%.1f' % seconds, code])
+        logwriter.writerow(['total', '', '', used_cores, '%.1f' % wall, len(jobs) - len(done)])
+
+    if len(done) < len(jobs):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
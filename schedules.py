@@ -0,0 +1,257 @@
+#!/usr/bin/env python3 -u
+'''Per-step learning rate schedules, and a harness comparing their time to accuracy.
+
+A schedule sets the learning rate of every optimizer step from the position in
+training, t = epoch + step / steps_per_epoch, so it is exact after a
+mid-epoch resume and does not depend on how often it was called before:
+
+    step      lr * 0.1^(milestones passed), constant within an epoch (the old
+              adjust_learning_rate: /10 after epochs 100 and 150)
+    cosine    linear warm-up over `warmup_epochs`, then cosine annealing to 0
+    onecycle  cosine ramp from lr/25 up to lr over `warmup_epochs`, then down
+              to lr/25e4, with SGD momentum cycled 0.95 -> 0.85 -> 0.95
+
+Schedules register themselves in SCHEDULES under the name used by
+--lr_schedule. `state_dict` holds everything needed to rebuild one, and
+load_schedule does that from a checkpoint. scaled_lr implements the linear
+scaling rule: the learning rate grows with the global batch size.
+
+Run as a script, it trains the same grid once per schedule and reports the
+epochs each trial took to reach a target test accuracy:
+
+    python schedules.py --target 80 [--schedules step cosine onecycle] [--parallel] [train.py arguments]
+
+Runs are named <name>_<schedule>, so their results_*/ logs sit side by side.
+The table is printed and written to schedules_<name>_<seed>.csv. With
+--parallel each run goes through scheduler.py; with --no-run only existing
+logs are summarized.
+'''
+from __future__ import print_function
+
+import argparse
+import csv
+import glob
+import math
+import os
+import subprocess
+import sys
+import time
+
+SCHEDULES = {}
+
+
+def register_schedule(name):
+    '''Class decorator adding a Schedule subclass to SCHEDULES under `name`.'''
+    def register(cls):
+        cls.name = name
+        SCHEDULES[name] = cls
+        return cls
+    return register
+
+
+def build_schedule(name, optimizer, lr, epochs, steps_per_epoch, warmup_epochs=None,
+                   milestones=(100, 150)):
+    return SCHEDULES[name](optimizer, lr, epochs, steps_per_epoch, warmup_epochs, milestones)
+
+
+def load_schedule(state, optimizer, steps_per_epoch):
+    '''Rebuild the schedule saved as `state` (see Schedule.state_dict) for `optimizer`.'''
+    return build_schedule(state['name'], optimizer, state['lr'], state['epochs'], steps_per_epoch,
+                          state['warmup_epochs'], state['milestones'])
+
+
+def scaled_lr(lr, batch_size, base_batch_size):
+    '''Linear scaling rule: `lr` is the rate for `base_batch_size`, scale it to `batch_size`.'''
+    return lr * batch_size / float(base_batch_size)
+
+
+class Schedule(object):
+    '''Base class of the schedules: the learning rate as a function of the position t.
+
+    Subclasses implement `decay(t)`, the multiplier of `lr` after the warm-up;
+    during the first `warmup_epochs` it ramps linearly up to 1.
+    `default_warmup` is the share of the epochs warmed up when
+    `warmup_epochs` is None.
+    '''
+    default_warmup = 0.
+
+    def __init__(self, optimizer, lr, epochs, steps_per_epoch, warmup_epochs=None,
+                 milestones=(100, 150)):
+        self.optimizer = optimizer
+        self.lr = lr
+        self.epochs = epochs
+        self.steps_per_epoch = max(steps_per_epoch, 1)
+        if warmup_epochs is None:
+            warmup_epochs = self.default_warmup * epochs
+        self.warmup_epochs = min(float(warmup_epochs), float(epochs))
+        self.milestones = list(milestones)
+        self.position = 0.
+
+    def factor(self, t):
+        if t < self.warmup_epochs:
+            return (t + 1. / self.steps_per_epoch) / self.warmup_epochs
+        return self.decay(t)
+
+    def decay(self, t):
+        raise NotImplementedError
+
+    def momentum(self, t):
+        '''SGD momentum at t, or None to leave it alone.'''
+        return None
+
+    def update(self, epoch, step=0):
+        '''Set the learning rate (and momentum) for step `step` of `epoch`.'''
+        self.position = t = epoch + step / float(self.steps_per_epoch)
+        lr = self.lr * self.factor(t)
+        momentum = self.momentum(t)
+        for param_group in self.optimizer.param_groups:
+            param_group['lr'] = lr
+            if momentum is not None and 'momentum' in param_group:
+                param_group['momentum'] = momentum
+        return lr
+
+    def current_lr(self):
+        return self.optimizer.param_groups[0]['lr']
+
+    def state_dict(self):
+        return {'name': self.name, 'lr': self.lr, 'epochs': self.epochs,
+                'warmup_epochs': self.warmup_epochs, 'milestones': self.milestones,
+                'position': self.position}
+
+
+@register_schedule('step')
+class StepSchedule(Schedule):
+
+    def decay(self, t):
+        # The old adjust_learning_rate set the rate for epoch m + 1 after epoch m
+        return 0.1 ** sum(int(t) > m for m in self.milestones)
+
+
+@register_schedule('cosine')
+class CosineSchedule(Schedule):
+    default_warmup = 0.05
+
+    def decay(self, t):
+        span = max(self.epochs - self.warmup_epochs, 1e-8)
+        progress = min(max((t - self.warmup_epochs) / span, 0.), 1.)
+        return 0.5 * (1 + math.cos(math.pi * progress))
+
+
+@register_schedule('onecycle')
+class OneCycleSchedule(Schedule):
+    default_warmup = 0.3
+    initial = 1 / 25.
+    final = 1 / 25e4
+    momentum_range = (0.95, 0.85)
+
+    def phase(self, t):
+        '''(start, end, fraction done) of the phase t is in, as factors of lr.'''
+        if t < self.warmup_epochs:
+            return self.initial, 1., t / self.warmup_epochs
+        span = max(self.epochs - self.warmup_epochs, 1e-8)
+        return 1., self.final, min((t - self.warmup_epochs) / span, 1.)
+
+    def factor(self, t):
+        start, end, done = self.phase(t)
+        return end + (start - end) * 0.5 * (1 + math.cos(math.pi * done))
+
+    def momentum(self, t):
+        high, low = self.momentum_range
+        start, end, done = self.phase(t)
+        # Momentum moves against the learning rate
+        if start < end:
+            high, low = low, high
+        return high + (low - high) * 0.5 * (1 + math.cos(math.pi * done))
+
+
+def epochs_to_target(logname, target):
+    '''(epochs until the test accuracy first reached `target` or None, best acc, epochs logged).'''
+    reached, best, epochs = None, 0., 0
+    with open(logname) as f:
+        for row in csv.DictReader(f):
+            acc = float(row['test acc'])
+            epochs = int(row['epoch']) + 1
+            best = max(best, acc)
+            if reached is None and acc >= target:
+                reached = epochs
+    return reached, best, epochs
+
+
+def run_logs(name, seed):
+    '''The results_*/ CSV logs written by runs with --name `name` and --seed `seed`.'''
+    return sorted(glob.glob('results_*/log_*_%s_%d.csv' % (name, seed)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare learning rate schedules by epochs to a target test accuracy; '
+                    'unrecognized arguments are passed to train.py')
+    parser.add_argument('--target', required=True, type=float,
+                        help='test accuracy (%%) to reach')
+    parser.add_argument('--schedules', nargs='+', default=sorted(SCHEDULES), choices=sorted(SCHEDULES),
+                        help='schedules to compare (default: all)')
+    parser.add_argument('--parallel', action='store_true',
+                        help='run the grid of every schedule with scheduler.py')
+    parser.add_argument('--no-run', dest='run', action='store_false',
+                        help='only summarize the logs of earlier runs')
+    args, train_args = parser.parse_known_args()
+    train_args = [a for a in train_args if a != '--']
+
+    run_parser = argparse.ArgumentParser(add_help=False)
+    run_parser.add_argument('--name', default='0')
+    run_parser.add_argument('--seed', default=0, type=int)
+    run_parser.add_argument('--lr_schedule')
+    run, _ = run_parser.parse_known_args(train_args)
+    if run.lr_schedule:
+        parser.error('--lr_schedule is chosen by --schedules')
+    if '--name' in train_args:
+        i = train_args.index('--name')
+        del train_args[i:i + 2]
+    train_args = [a for a in train_args if not a.startswith('--name=')]
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    runner = os.path.join(here, 'scheduler.py' if args.parallel else 'train.py')
+    seconds = {}
+    for schedule in args.schedules:
+        name = '%s_%s' % (run.name, schedule)
+        if args.run:
+            print('==> %s: %s' % (schedule, ' '.join(['--name', name, '--lr_schedule', schedule]
+                                                       + train_args)))
+            sys.stdout.flush()
+            start = time.time()
+            code = subprocess.call([sys.executable, runner, '--name', name, '--lr_schedule', schedule]
+                                   + train_args)
+            seconds[schedule] = time.time() - start
+            if code != 0:
+                print('%s run failed (exit %d)' % (schedule, code))
+
+    rows = []
+    for schedule in args.schedules:
+        for logname in run_logs('%s_%s' % (run.name, schedule), run.seed):
+            reached, best, epochs = epochs_to_target(logname, args.target)
+            rows.append([schedule, logname, reached, best, epochs])
+
+    print('\nEpochs to %.2f%% test accuracy' % args.target)
+    print('%-10s %8s %10s %10s %10s %10s' % ('schedule', 'trials', 'reached', 'epochs',
+                                             'best acc', 'seconds'))
+    for schedule in args.schedules:
+        trials = [row for row in rows if row[0] == schedule]
+        reached = sorted(row[2] for row in trials if row[2] is not None)
+        median = reached[len(reached) // 2] if reached else None
+        best = sum(row[3] for row in trials) / len(trials) if trials else float('nan')
+        print('%-10s %8d %10d %10s %10.3f %10s'
+              % (schedule, len(trials), len(reached), median if median is not None else '-', best,
+                 '%.1f' % seconds[schedule] if schedule in seconds else '-'))
+
+    logname = 'schedules_' + run.name + '_' + str(run.seed) + '.csv'
+    with open(logname, 'w') as logfile:
+        logwriter = csv.writer(logfile, delimiter=',')
+        logwriter.writerow(['schedule', 'log', 'target', 'epochs to target', 'best test acc',
+                            'epochs'])
+        for schedule, log, reached, best, epochs in rows:
+            logwriter.writerow([schedule, log, args.target, '' if reached is None else reached,
+                                '%.3f' % best, epochs])
+
+
+if __name__ == '__main__':
+    main()
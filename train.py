@@ -10,23 +10,43 @@
 #train.py --lr=0.1 --seed=20170922 --decay=1e-4 --epoch=2 --trials=2 --dataset_dir=../Datasets --iterations 2 --image_size 224 -v2 for mixup version 2
 from __future__ import print_function
 
-import argparse, csv, os, sys, glob
+import argparse, copy, csv, io, os, sys, glob, time
+from contextlib import nullcontext
 
-import numpy as np
 import torch
 from torch.autograd import Variable
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
 import torch.optim as optim
 import torchvision.transforms as transforms
-import torchvision.datasets as datasets
 
 import models
 import torchvision.models as model
-from utils import progress_bar, make_prediction
+from utils import (progress_bar, configure_progress, make_prediction, model_step_rate, autocast,
+                   choose_memory_format, choose_eval_batch_size, evaluate)
+from data import DataContext, autotune_loader, pack_image_folder
+from augment import BatchAugment
+from checkpoints import CheckpointWriter, load_checkpoint
+from compiler import compile_model, eager_module
+from halving import SuccessiveHalving
+from metrics import FORMATS, MetricsSink, PhaseTimer, phase_columns
+from schedules import SCHEDULES, build_schedule, load_schedule, scaled_lr
+from distributed import (init_distributed, is_distributed, is_main_process, all_gather, all_reduce_sum, barrier,
+                         wrap_model)
+from mixup import MIXERS, MixupCollate, MixupCrossEntropy, build_mixer, empty_rows, split_batchnorm
 
 parser = argparse.ArgumentParser(description='PyTorch CIFAR10 Training')
 parser.add_argument('--lr', default=0.1, type=float, help='learning rate')
+parser.add_argument('--lr_schedule', default='step', choices=sorted(SCHEDULES),
+                    help='learning rate schedule, set every step (default: step, /10 after --lr_milestones)')
+parser.add_argument('--lr_milestones', nargs='+', default=[100, 150], type=int,
+                    help='epochs after which the step schedule divides the learning rate by 10')
+parser.add_argument('--warmup_epochs', default=None, type=float,
+                    help='epochs of warm-up (default: 5%% of --epoch for cosine, 30%% for onecycle, 0 for step)')
+parser.add_argument('--lr_scaling', default='none', choices=['none', 'linear'],
+                    help='linear: --lr is for --lr_base_batch samples, scale it to the global batch size')
+parser.add_argument('--lr_base_batch', default=128, type=int,
+                    help='batch size --lr is meant for with --lr_scaling linear')
 parser.add_argument('--resume', '-r', action='store_true',
                     help='resume from checkpoint')
 parser.add_argument('--model', default="ResNet18", type=str,
@@ -53,9 +73,105 @@ parser.add_argument('--image_size', default=32, type=int,
                     help='input image size')
 parser.add_argument('--mixup_v2', '-v2', action='store_true',
                     help='Add a version of mixup that uses original dataset')
+parser.add_argument('--cache_dir', default='cache', type=str,
+                    help='folder with packed uint8 datasets, used when up to date')
+parser.add_argument('--pack', action='store_true',
+                    help='decode each dataset into --cache_dir before training')
+parser.add_argument('--batch_augment', action='store_true',
+                    help='augment whole uint8 batches at collate time instead of per image')
+parser.add_argument('--workers', default=2, type=int,
+                    help='DataLoader worker processes per loader')
+parser.add_argument('--prefetch-factor', default=2, type=int,
+                    help='batches prefetched by each worker')
+parser.add_argument('--no-persistent-workers', dest='persistent_workers', action='store_false',
+                    help='restart loader workers every epoch')
+parser.add_argument('--pin-memory', action='store_true',
+                    help='use pinned host memory for loader batches')
+parser.add_argument('--eval-batch-size', default=0, type=int,
+                    help='batch size of the evaluation loaders (0: chosen per model by timing inference)')
+parser.add_argument('--autotune-loader', action='store_true',
+                    help='time loader settings on each dataset and keep the best one')
+parser.add_argument('--per_sample_lam', action='store_true',
+                    help='draw a separate mixup lambda (and CutMix box) for every sample')
+parser.add_argument('--mix', default='mixup', choices=sorted(MIXERS),
+                    help='batch mixing strategy (default: mixup)')
+parser.add_argument('--fused_v2', action='store_true',
+                    help='with --mixup_v2, run the clean and mixed batches in one forward pass')
+parser.add_argument('--v2_bn', default='split', choices=['split', 'shared'],
+                    help='BatchNorm statistics of the fused pass: per half (as two passes) or shared')
+parser.add_argument('--manifold_mixup', action='store_true',
+                    help='mix hidden activations at a random stage of a staged model')
+parser.add_argument('--manifold_stages', nargs='+', type=int, default=None,
+                    help='stages to mix before with --manifold_mixup, 1 to the head (default: all hidden stages)')
+parser.add_argument('--report_every', default=20, type=int,
+                    help='batches between progress updates; metrics stay on the device in between')
+parser.add_argument('--progress', default='bar', choices=['bar', 'log', 'none'],
+                    help='progress reporting: bar, JSON lines, or nothing')
+parser.add_argument('--progress_rate', default=2., type=float,
+                    help='maximum progress updates per second')
+parser.add_argument('--progress_log', default=None, type=str,
+                    help='file receiving progress output instead of stdout')
+parser.add_argument('--amp', default='none', choices=['none', 'bf16'],
+                    help='autocast forward and loss to bfloat16 (fp32 master weights)')
+parser.add_argument('--compile', default='none',
+                    choices=['none', 'default', 'reduce-overhead', 'max-autotune'],
+                    help='torch.compile mode for the model (compiled once per process and reused)')
+parser.add_argument('--memory-format', default='contiguous', choices=['contiguous', 'channels_last', 'auto'],
+                    help='layout of model weights and input batches; auto times both per model')
+parser.add_argument('--collate_mixup', action='store_true',
+                    help='mix batches inside the DataLoader workers (seeded per batch)')
+parser.add_argument('--accum_steps', default=1, type=int,
+                    help='micro-batches per batch: gradients are accumulated and the optimizer steps once per batch')
+parser.add_argument('--job', nargs=3, metavar=('DATASET', 'ITERATION', 'TRIAL'), default=None,
+                    help='run a single cell of the dataset x iteration x trial grid (see scheduler.py)')
+parser.add_argument('--keep_checkpoints', default=1, type=int,
+                    help='versions of each checkpoint to keep (older ones get a .1, .2, ... suffix)')
+parser.add_argument('--snapshot_every', default=0, type=int,
+                    help='steps between resumable snapshots of the full training state (0: off)')
+parser.add_argument('--metrics_format', nargs='+', default=['csv'], choices=FORMATS,
+                    help='formats of the per-epoch (and sampled per-step) logs: csv, jsonl, tensorboard')
+parser.add_argument('--metrics_steps', default=0, type=int,
+                    help='log the phase timings of every N-th step of an epoch (0: only per-epoch totals)')
+parser.add_argument('--metrics_flush', default=30., type=float,
+                    help='seconds between writes of the buffered metric logs')
+parser.add_argument('--halving', action='store_true',
+                    help='stop trials whose test accuracy falls behind at successive-halving rungs')
+parser.add_argument('--halving_min_epochs', default=20, type=int,
+                    help='first successive-halving rung; later rungs are eta times further apart')
+parser.add_argument('--halving_eta', default=3, type=int,
+                    help='only the best 1/eta of the trials at a rung continue')
+parser.add_argument('--halving_group', default=None, type=str,
+                    help='runs sharing a group compete at the rungs (default: name and seed of this run)')
+parser.add_argument('--dist-backend', default='gloo', choices=['gloo', 'nccl'],
+                    help='torch.distributed backend when started with torchrun')
+parser.add_argument('--accum_mix', default='logical', choices=['logical', 'micro'],
+                    help='with --accum_steps, pair samples across the whole batch or only within each micro-batch')
 args = parser.parse_args()
 
+if args.manifold_mixup and (args.baseline or args.fused_v2):
+    parser.error('--manifold_mixup cannot be combined with --baseline or --fused_v2')
+if args.collate_mixup and (args.baseline or args.manifold_mixup):
+    parser.error('--collate_mixup cannot be combined with --baseline or --manifold_mixup')
+if not 1 <= args.accum_steps <= args.batch_size:
+    parser.error('--accum_steps must be between 1 and --batch-size')
+if args.accum_steps > 1 and args.accum_mix == 'logical' and args.manifold_mixup:
+    parser.error('--manifold_mixup mixes hidden activations, use --accum_mix micro with --accum_steps')
+if args.accum_steps > 1 and args.accum_mix == 'micro' and args.collate_mixup:
+    parser.error('--collate_mixup mixes whole batches, use --accum_mix logical with --accum_steps')
+
+# One process per rank under torchrun; a plain run is rank 0 of 1
+rank, world_size = init_distributed(args.dist_backend)
+
+configure_progress(args.progress if is_main_process() else 'none',
+                   args.progress_rate, args.report_every, args.progress_log)
+
 use_cuda = torch.cuda.is_available()
+device_type = 'cuda' if use_cuda else 'cpu'
+if use_cuda and is_distributed():
+    torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+
+# Seconds spent in data loading, forward, backward, step, eval and checkpoints, see metrics.py
+timer = PhaseTimer(sample_every=args.metrics_steps, sync=torch.cuda.synchronize if use_cuda else None)
 
 torch.manual_seed(123)
 if torch.cuda.is_available():
@@ -91,160 +207,421 @@ transform_test = transforms.Compose([
     transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
 ])
 
+# Layout of weights and batches; 'auto' is resolved per model when it is first built
+memory_format = torch.channels_last if args.memory_format == 'channels_last' else torch.contiguous_format
+memory_formats = {}
+# Evaluation batch size per model for --eval-batch-size 0
+eval_batch_sizes = {}
 
-def mixup_data(x, y, alpha=1.0, use_cuda=True):
-    '''Returns mixed inputs, pairs of targets, and lambda'''
-    if alpha > 0:
-        lam = np.random.beta(alpha, alpha)
-    else:
-        lam = 1
-
-    batch_size = x.size()[0]
-    if use_cuda:
-        index = torch.randperm(batch_size).cuda()
-    else:
-        index = torch.randperm(batch_size)
+# Batched equivalents of the transforms above, used as collate_fn with --batch_augment
+collate_train = (BatchAugment(args.image_size, crop=args.augment, flip=args.augment,
+                              memory_format=memory_format) if args.batch_augment else None)
+collate_test = (BatchAugment(args.image_size, crop=False, flip=False,
+                             memory_format=memory_format) if args.batch_augment else None)
 
-    mixed_x = lam * x + (1 - lam) * x[index, :]
-    y_a, y_b = y, y[index]
-    return mixed_x, y_a, y_b, lam
 
 # Idea is to include the original dataset while training with mixup so as to add more data to the training
+# Every rank mixes its own shard, with its own permutations and lambdas
+mixer = build_mixer(args.mix, args.alpha, per_sample=args.per_sample_lam,
+                    seed=[args.seed, rank] if is_distributed() else args.seed)
+if args.collate_mixup:
+    collate_train = MixupCollate(mixer, collate_train, include_clean=args.mixup_v2)
+
+# Checkpoints are written by a background thread, see checkpoints.py
+writer = CheckpointWriter(keep=args.keep_checkpoints)
+
+# `criterion` is a MixupCrossEntropy: one log-softmax serves both targets
 def mixup_criterion_v1(criterion, pred, y_a, y_b, lam, pred1):
-    return lam * criterion(pred, y_a) + (1 - lam) * criterion(pred, y_b) + criterion(pred1, y_a)
+    return criterion(pred, y_a, y_b, lam) + criterion(pred1, y_a)
 
 def mixup_criterion(criterion, pred, y_a, y_b, lam):
-    return lam * criterion(pred, y_a) + (1 - lam) * criterion(pred, y_b)
+    return criterion(pred, y_a, y_b, lam)
+
+# Losses and correct counts are summed on the device (the loss in float64, so the
+# sums match adding up loss.item() on the host) and only read when the progress
+# reporter renders, which is why the messages are passed as lambdas.
+#
+# With --accum_steps K every loader batch is a logical batch of --batch-size
+# samples that is split into K micro-batches; each one runs forward and backward
+# with its loss weighted by its share of the batch, and the optimizer steps once
+# per logical batch, so the gradient is that of the whole batch.
+def premix(inputs, targets):
+    '''Mix a whole logical batch up front, in the layout of --collate_mixup batches.'''
+    if args.mixup_v2:
+        n = inputs.size(0)
+        both = empty_rows(inputs, 2 * n)
+        both[:n] = inputs
+        _, targets_a, targets_b, lam = mixer(inputs, targets, out=both[n:])
+        return [both, targets, targets_a, targets_b, lam]
+    mixed, targets_a, targets_b, lam = mixer(inputs, targets)
+    return [mixed, targets, targets_a, targets_b, lam]
+
+
+def micro_batches(batch, chunks):
+    '''Split `batch` into `chunks` micro-batches, keeping clean and mixed rows of mixup_v2 together.'''
+    if chunks == 1:
+        yield batch
+        return
+    inputs, rest = batch[0], batch[1:]
+    n = rest[0].size(0)
+    size = -(-n // chunks)
+    for start in range(0, n, size):
+        end = min(start + size, n)
+        part = inputs[start:end]
+        if inputs.size(0) == 2 * n:
+            part = torch.cat([part, inputs[n + start:n + end]])
+        yield [part] + [t[start:end] for t in rest]
+
 
 def train(epoch):
+    global resume_sums
     print('\nEpoch: %d' % epoch)
     net.train()
     train_loss = 0
     reg_loss = 0
     correct = 0
     total = 0
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        if use_cuda:
-            inputs, targets = inputs.cuda(), targets.cuda()
-
-        if not args.baseline:
+    start_step = 0
+    if resume_sums is not None:
+        # Continue a snapshot's epoch; the loader skips the batches it had trained
+        start_step, sums = resume_sums
+        resume_sums = None
+        if is_main_process():
+            train_loss, correct, total = sums
+            if use_cuda:
+                train_loss, correct = train_loss.cuda(), correct.cuda()
+    start = end = time.time()
+    for batch_idx, batch in enumerate(trainloader, start_step):
+        timer.start_step(batch_idx)
+        batch = [t.cuda() for t in batch] if use_cuda else list(batch)
+        batch[0] = batch[0].contiguous(memory_format=memory_format)
+        timer.add('data', time.time() - end)
+        if args.accum_steps > 1 and args.accum_mix == 'logical' and len(batch) == 2 and not args.baseline:
+            batch = premix(*batch)
+        batch_size = batch[1].size(0)
+
+        schedule.update(epoch, batch_idx)
+        optimizer.zero_grad() # Zeroes out the gradients from previous passes if any
+        micros = list(micro_batches(batch, args.accum_steps))
+        for i, micro in enumerate(micros):
+            share = micro[1].size(0) / batch_size
+            # Under DDP only the last micro-batch all-reduces the accumulated gradients
+            with net.no_sync() if is_distributed() and i + 1 < len(micros) else nullcontext():
+                with timer.phase('forward'):
+                    loss, micro_correct, micro_total = train_step(micro)
+                with timer.phase('backward'):
+                    (loss * share).backward() # Accumulates this micro-batch's share of the gradient
+            train_loss += loss.detach().double() * share
+            correct += micro_correct
+            total += micro_total
+        with timer.phase('step'):
+            optimizer.step() # Update variables with gradient values
+
+        if (args.snapshot_every and (batch_idx + 1) % args.snapshot_every == 0
+                and batch_idx + 1 < len(trainloader)):
+            sums = all_reduce_sum(train_loss, correct, total)
+            rank_rng_states = all_gather(rng_state(batch_idx + 1))
+            if is_main_process():
+                snapshot(epoch, batch_idx + 1, sums, rank_rng_states)
+
+        sample = timer.end_step()
+        if sample is not None and metrics is not None:
+            metrics.write('step', epoch * len(trainloader) + batch_idx,
+                          dict(epoch=epoch, batch=batch_idx, lr=schedule.current_lr(), **phase_columns(sample)))
+        progress_bar(batch_idx, len(trainloader),
+                     lambda: 'Loss: %.3f | Reg: %.5f | Acc: %.3f%% (%d/%d)'
+                     % (train_loss/(batch_idx+1), reg_loss/(batch_idx+1),
+                        100.*correct/total, correct, total))
+        end = time.time()
+    print('Train: %.1f ms/step | lr %.6f' % (1e3 * (time.time() - start) / (batch_idx + 1),
+                                            schedule.current_lr()))
+    if mixer.calls:
+        print('Mix (%s): %.3f ms/step' % (mixer.name, mixer.cost()))
+        mixer.reset_cost()
+    # Materialize the on-device sums once per epoch, summed over the ranks
+    train_loss, correct, total, batches = all_reduce_sum(train_loss, correct, total, batch_idx + 1)
+    train_loss, correct = train_loss.item(), correct.cpu()
+    return (train_loss/(float(batches) - 1), reg_loss/batch_idx, 100.*correct/total)
+
+
+def train_step(batch):
+    '''Forward pass and loss of one (micro-)batch: (loss, correct, total).'''
+    inputs, targets = batch[:2]
+    correct = 0
+    total = 0
 
-            # Before transforming the data to mixup standard
+    # Forward and loss run under autocast with --amp; weights stay fp32
+    with autocast(args.amp, device_type):
+        if len(batch) > 2:
+            # Already mixed (by the loader or for the whole logical batch);
+            # with mixup_v2 the clean rows come first
+            targets_a, targets_b, lam = batch[2:]
+            n = targets.size(0)
+            if args.mixup_v2 and args.fused_v2:
+                with split_batchnorm(net, 2 if args.v2_bn == 'split' else 1):
+                    outputs1, outputs = net(inputs).split(n)
+            elif args.mixup_v2:
+                outputs1 = net(inputs[:n])
+                outputs = net(inputs[n:])
+            else:
+                outputs = net(inputs)
+
+        elif args.mixup_v2 and args.fused_v2:
+            # Clean and mixed samples share one forward pass, then the logits are split
+            n = inputs.size(0)
+            both = empty_rows(inputs, 2 * n)
+            both[:n] = inputs
+            _, targets_a, targets_b, lam = mixer(inputs, targets, out=both[n:])
+            with split_batchnorm(net, 2 if args.v2_bn == 'split' else 1):
+                outputs1, outputs = net(both).split(n)
+
+        elif args.manifold_mixup:
+            # Run the shared prefix once, mix there and continue from the same stage
+            stage = manifold_stages[torch.randint(len(manifold_stages), ()).item()]
+            hidden = net(inputs, lin=0, lout=stage - 1)
             if args.mixup_v2:
-                outputs1 = net(inputs)
+                outputs1 = net(hidden, lin=stage)
+            mixed, targets_a, targets_b, lam = mixer(hidden, targets)
+            outputs = net(mixed, lin=stage)
 
-            inputs, targets_a, targets_b, lam = mixup_data(inputs, targets,
-                                                       args.alpha, use_cuda)
-        # Make Prediction
-        outputs = net(inputs)
+        else:
+            if not args.baseline:
+
+                # Before transforming the data to mixup standard
+                if args.mixup_v2:
+                    outputs1 = net(inputs)
+
+                inputs, targets_a, targets_b, lam = mixer(inputs, targets)
+            # Make Prediction
+            outputs = net(inputs)
 
         if args.baseline:
             loss = criterion(outputs, targets)
-            train_loss += loss.data.item()
             _, predicted = torch.max(outputs.data, 1)
             total += targets.size(0)
-            correct += predicted.eq(targets.data).cpu().sum()
+            correct += predicted.eq(targets.data).sum()
 
         elif args.mixup_v2:
             # outputs1 = net(inputs)
-            loss = mixup_criterion(criterion, outputs, targets_a, targets_b, lam) + criterion(outputs1, targets) # Add loss from predicting the original dataset
-            train_loss += loss.data.item()
+            loss = mixup_criterion(mix_criterion, outputs, targets_a, targets_b, lam) + criterion(outputs1, targets) # Add loss from predicting the original dataset
 
             # Predict for the mixup data samples
             _, predicted = torch.max(outputs.data, 1)
             total += targets.size(0)
-            correct += (lam * predicted.eq(targets_a.data).cpu().sum().float()
-                        + (1 - lam) * predicted.eq(targets_b.data).cpu().sum().float())
+            correct += (lam * predicted.eq(targets_a.data).float()
+                        + (1 - lam) * predicted.eq(targets_b.data).float()).sum()
 
             # Add correctly predicted values from the original dataset
             _, predicted1 = torch.max(outputs1.data, 1)
             total += targets.size(0)
-            correct += predicted1.eq(targets.data).cpu().sum()
+            correct += predicted1.eq(targets.data).sum()
 
         else:
-            loss = mixup_criterion(criterion, outputs, targets_a, targets_b, lam)
-            train_loss += loss.data.item()
+            loss = mixup_criterion(mix_criterion, outputs, targets_a, targets_b, lam)
             _, predicted = torch.max(outputs.data, 1)
             total += targets.size(0)
-            correct += (lam * predicted.eq(targets_a.data).cpu().sum().float()
-                        + (1 - lam) * predicted.eq(targets_b.data).cpu().sum().float())
+            correct += (lam * predicted.eq(targets_a.data).float()
+                        + (1 - lam) * predicted.eq(targets_b.data).float()).sum()
+    return loss, correct, total
+
+
+def test(epoch, loader, current_exp, amp=None, save=True, phase='eval'):
+    global best_acc, eval_seconds
+    amp = args.amp if amp is None else amp
+    start = time.time()
+    # Inference mode, no autograd graphs; see utils.evaluate
+    with timer.phase(phase) if phase else nullcontext():
+        test_loss, correct, total = evaluate(net, loader, criterion, amp, memory_format)
+    test_loss, correct, total = all_reduce_sum(test_loss, correct, total)
+    test_loss, correct = test_loss.item(), correct.cpu()
+    eval_seconds = time.time() - start
+    acc = 100.*correct/total
+    if save and acc > best_acc:
+        # Every rank sees the same accuracy, rank 0 writes the file
+        rank_rng_states = all_gather(rng_state())
+        if is_main_process():
+            checkpoint(acc, epoch, current_exp, rank_rng_states)
+        best_acc = acc
 
+    return (test_loss/float(total), acc)
 
-        optimizer.zero_grad() # Zeroes out the gradients from previous passes if any
-        loss.backward() # Computes the gradient values based on calculus
-        optimizer.step() # Update variables with gradient values
 
-        progress_bar(batch_idx, len(trainloader),
-                     'Loss: %.3f | Reg: %.5f | Acc: %.3f%% (%d/%d)'
-                     % (train_loss/(batch_idx+1), reg_loss/(batch_idx+1),
-                        100.*correct/total, correct, total))
-    return (train_loss/batch_idx, reg_loss/batch_idx, 100.*correct/total)
+def amp_train_speedup(steps=2):
+    '''Train step speedup of --amp over fp32, timed on a copy of the current weights.'''
+    probe = copy.deepcopy(eager_module(net))
+    # Synthetic batches must not move the training RNG streams
+    with torch.random.fork_rng(devices=[torch.cuda.current_device()] if use_cuda else []):
+        rates = dict((amp, model_step_rate(probe, args.batch_size, args.image_size, len(testset.classes),
+                                           steps, memory_format, amp))
+                     for amp in ('none', args.amp))
+    del probe
+    return rates[args.amp] / rates['none']
 
 
-def test(epoch, loader, current_exp):
-    global best_acc
-    net.eval()
-    test_loss = 0
-    correct = 0
-    total = 0
-    for batch_idx, (inputs, targets) in enumerate(loader):
-        if use_cuda:
-            inputs, targets = inputs.cuda(), targets.cuda()
-        outputs = net(inputs)
-        loss = criterion(outputs, targets)
-
-        test_loss += loss.data.item()
-        _, predicted = torch.max(outputs.data, 1)
-        total += targets.size(0)
-        correct += predicted.eq(targets.data).cpu().sum()
-
-        progress_bar(batch_idx, len(testloader),
-                     'Loss: %.3f | Acc: %.3f%% (%d/%d)'
-                     % (test_loss/(batch_idx+1), 100.*correct/total,
-                        correct, total))
-    acc = 100.*correct/total
-    if acc > best_acc:
-        checkpoint(acc, epoch, current_exp)
-        best_acc = acc
+def checkpoint_path(current_exp):
+    return f'./{direct_for_checkpoint}/ckpt.t7' + current_exp + args.name + '_' + str(args.seed)
 
-    return (test_loss/batch_idx, 100.*correct/total)
 
+def rng_state(step=None):
+    '''This rank's torch, CUDA and mixup RNG states; for a snapshot `step` batches into
+    the epoch, also the shuffle generator state it resumes from (see snapshot).'''
+    state = {
+        'rng_state': torch.get_rng_state(),
+        'cuda_rng_state': torch.cuda.get_rng_state_all() if use_cuda else None,
+        'mixer_rng_state': mixer.rng.bit_generator.state,
+    }
+    if step is not None:
+        state['shuffle_state'] = context.epoch_state() if step else context.generator.get_state()
+    return state
 
-def checkpoint(acc, epoch, current_exp):
-    # Save checkpoint.
-    print('Saving..')
+
+def training_state(acc, epoch, rank_rng_states):
+    '''Checkpoint dict; `rank_rng_states` is the list of every rank's rng_state() (see all_gather).'''
     state = {
-        'net': net,
+        'net': eager_module(net).state_dict(),
+        'optimizer': optimizer.state_dict(),
         'acc': acc,
         'epoch': epoch,
-        'rng_state': torch.get_rng_state()
+        'lr_schedule': schedule.state_dict(),
+        'rank_rng_states': rank_rng_states,
     }
-    if not os.path.isdir(direct_for_checkpoint):
-        os.mkdir(direct_for_checkpoint)
-    torch.save(state, f'./{direct_for_checkpoint}/ckpt.t7' + current_exp + args.name + '_'
-               + str(args.seed))
-
+    # Rank 0's states also at the top level, as older checkpoints have them
+    state.update(rank_rng_states[0])
+    return state
 
-def adjust_learning_rate(optimizer, epoch):
-    """decrease the learning rate at 100 and 150 epoch"""
-    lr = args.lr
-    if epoch >= 100:
-        lr /= 10
-    if epoch >= 150:
-        lr /= 10
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
 
+def checkpoint(acc, epoch, current_exp, rank_rng_states):
+    # Save checkpoint: a CPU snapshot now, the file is written in the background
+    print('Saving..')
+    with timer.phase('checkpoint'):
+        writer.save(training_state(acc, epoch, rank_rng_states), checkpoint_path(current_exp))
+
+
+def snapshot(epoch, step, sums, rank_rng_states):
+    '''Save where training is: `step` batches into `epoch`, with the epoch's metric sums so far.
+
+    The shuffle generator state is the one the epoch started from, so a resumed
+    run replays the same order and skips the first `step` batches.
+    '''
+    with timer.phase('checkpoint'):
+        state = training_state(best_acc, epoch, rank_rng_states)
+        state.update(step=step, sums=sums)
+        writer.save(state, checkpoint_path(current_exp) + '.snapshot')
+
+
+def restore(state):
+    '''Load a checkpoint's optimizer, schedule and RNG state (the weights are loaded when the model is built).
+
+    A snapshot also sets up the loader to replay its epoch from the saved step.
+    '''
+    global schedule
+    optimizer.load_state_dict(state['optimizer'])
+    if state.get('lr_schedule') is not None:
+        # Continue the schedule the checkpoint was trained with
+        schedule = load_schedule(state['lr_schedule'], optimizer, len(trainloader))
+        if schedule.name != args.lr_schedule:
+            print('==> Continuing the checkpoint\'s %s schedule' % schedule.name)
+    rank_rng_states = state.get('rank_rng_states') or [state]
+    if len(rank_rng_states) == world_size:
+        rng = rank_rng_states[rank]
+    else:
+        # Saved by an older version or with another number of ranks: rank 0's states, and
+        # a mixer stream of this rank's own so the ranks do not mix their shards alike
+        rng = dict(rank_rng_states[0], mixer_rng_state=None)
+        mixer.reseed([args.seed, rank, state['epoch'], state.get('step', 0)])
+    torch.set_rng_state(rng['rng_state']) # Set the random number generator state
+    if use_cuda and rng.get('cuda_rng_state') is not None:
+        torch.cuda.set_rng_state_all(rng['cuda_rng_state'])
+    if rng.get('mixer_rng_state') is not None:
+        mixer.rng.bit_generator.state = rng['mixer_rng_state']
+    if 'step' in state:
+        context.resume_epoch(rng['shuffle_state'], state['step'])
+
+
+def autotune_loader_for(context, results):
+    '''Pick loader settings for `context` and log the sweep next to the results CSVs.'''
+    num_classes = len(context.testset.classes)
+    if args.image_size == 32:
+        probe = models.__dict__[args.model](num_classes=num_classes)
+    else:
+        probe = model.densenet161(num_classes=num_classes)
+    if use_cuda:
+        probe.cuda()
+    step_rate = model_step_rate(probe, args.batch_size, args.image_size, num_classes)
+    del probe
+
+    max_workers = os.cpu_count() or 1
+    workers = sorted(set([0] + [w for w in (1, 2, 4, 8, 16) if w <= max_workers]))
+    pin_memory = (False, True) if use_cuda else (False,)
+    sweep, chosen = autotune_loader(context, step_rate, workers=workers, pin_memory=pin_memory)
+
+    if not is_main_process():
+        return
+    logname = results + '/loader_' + args.name + '_' + str(args.seed) + '.csv'
+    with open(logname, 'w') as logfile:
+        logwriter = csv.writer(logfile, delimiter=',')
+        logwriter.writerow(['num workers', 'prefetch factor', 'pin memory',
+                            'loader img/s', 'model img/s', 'chosen'])
+        for options, rate in sweep:
+            logwriter.writerow([options['num_workers'], options['prefetch_factor'],
+                                options['pin_memory'], '%.1f' % rate, '%.1f' % step_rate,
+                                options == chosen])
+    print('Loader autotune: model step %.1f img/s, chose %s' % (step_rate, chosen))
+
+
+if args.job:
+    # A single job of the grid, e.g. started by scheduler.py
+    job_dataset, job_iteration, job_trial = args.job[0], int(args.job[1]), int(args.job[2])
+    dataset_list = [d for d in dataset_list if d.split("/")[-1] == job_dataset]
+    if not dataset_list:
+        sys.exit('ERROR: dataset %s not found in %s' % (job_dataset, args.dataset_dir))
 
 for dataset in dataset_list:
 
     # 1. Location to save the output for the given dataset
     current_dataset_file = dataset.split("/")[-1] + '_.txt'
 
+    if args.pack:
+        if is_main_process():
+            for split in ('train', 'test'):
+                print('Packing', split, 'split ->',
+                      pack_image_folder(os.path.join(dataset, split), args.cache_dir))
+        barrier()
+
+    # 2. Datasets and loaders are shared by every iteration and trial
+    context = DataContext(dataset, transform_train, transform_test, args.batch_size,
+                          cache_dir=args.cache_dir, raw=args.batch_augment,
+                          collate_train=collate_train, collate_test=collate_test,
+                          seeded=args.collate_mixup,
+                          num_workers=args.workers, prefetch_factor=args.prefetch_factor,
+                          persistent_workers=args.persistent_workers,
+                          pin_memory=args.pin_memory, eval_batch_size=args.eval_batch_size or args.batch_size,
+                          num_replicas=world_size, rank=rank)
+    results = "results_" + dataset.split("/")[-1]
+    if is_main_process():
+        os.makedirs(results, exist_ok=True)
+    if args.autotune_loader:
+        autotune_loader_for(context, results)
+    trainset, testset = context.trainset, context.testset
+    trainloader, testloader = context.trainloader, context.testloader
+    halving = None
+    if args.halving:
+        group = args.halving_group or args.name + '_' + str(args.seed)
+        halving = SuccessiveHalving(results + '/halving_' + group + '.csv', args.epoch,
+                                    args.halving_min_epochs, args.halving_eta)
+
     for iteration in range(args.iterations):
         for trial in range(args.trials):
+            if args.job and (iteration, trial) != (job_iteration, job_trial):
+                continue
 
             print("Iteration", iteration, " Experiment: ", trial, "for dataset", dataset)
+            # Shuffle, weight init, dropout and mixing depend only on (--seed, iteration, trial),
+            # so a scheduler.py job starts exactly like the same trial of a sequential run
+            trial_seed = args.seed + iteration * args.trials + trial
+            context.reseed(trial_seed)
+            torch.manual_seed(123 + trial_seed)
+            mixer.reseed([args.seed, iteration, trial] + ([rank] if is_distributed() else []))
 
             # Location to save checkpoint
             current_exp = "_ite_" + str(iteration) + "_trial_" + str(trial) + "_dataset_" + dataset.split("/")[-1] + "_"
@@ -253,80 +630,205 @@ for dataset in dataset_list:
             best_acc = 0  # best test accuracy
             start_epoch = 0  # start from epoch 0 or last checkpoint epoch
 
-            trainset = datasets.ImageFolder(os.path.join(dataset, 'train'),
-                                                      transform_train)
-            trainloader = torch.utils.data.DataLoader(trainset,
-                                                      batch_size=args.batch_size,
-                                                      shuffle=True, num_workers=2)
-
-            testset = datasets.ImageFolder(os.path.join(dataset, 'test'),
-                                                      transform_test)
-            testloader = torch.utils.data.DataLoader(testset, batch_size=8,
-                                                     shuffle=False, num_workers=2)
-
             # Model
+            print('==> Building model..')
+            if args.image_size == 32:
+                net = models.__dict__[args.model](num_classes=len(testset.classes))
+            else:
+                net = model.densenet161()
+                net.classifier = nn.Linear(net.classifier.in_features, len(testset.classes))
+
+            resume_state = None
+            resume_sums = None
             if args.resume:
-                # Load checkpoint.
+                # Load checkpoint: the latest snapshot if there is one, else the best checkpoint
                 print('==> Resuming from checkpoint..')
                 assert os.path.isdir(direct_for_checkpoint), 'Error: no checkpoint directory found!'
-                checkpoint = torch.load(f'./{direct_for_checkpoint}/ckpt.t7' + current_exp + args.name + '_'
-                                        + str(args.seed))
-                net = checkpoint['net']
-                best_acc = checkpoint['acc']
-                start_epoch = checkpoint['epoch'] + 1
-                rng_state = checkpoint['rng_state']
-                torch.set_rng_state(rng_state) # Set the random number generator state
-            else:
-                print('==> Building model..')
-
-
-                if args.image_size == 32:
-                    net = models.__dict__[args.model](num_classes=len(testset.classes))
+                path = checkpoint_path(current_exp)
+                if os.path.exists(path + '.snapshot'):
+                    path += '.snapshot'
+                resume_state = load_checkpoint(path)
+                net.load_state_dict(resume_state['net'])
+                best_acc = resume_state['acc']
+                if 'step' in resume_state:
+                    start_epoch = resume_state['epoch']
+                    print('==> Epoch %d, step %d' % (start_epoch, resume_state['step']))
                 else:
-                    net = model.densenet161()
-                    net.classifier = nn.Linear(net.classifier.in_features, len(testset.classes))
+                    start_epoch = resume_state['epoch'] + 1
 
-            results = "results_" + dataset.split("/")[-1]
-            if not os.path.isdir(results):
-                os.mkdir(results)
             logname = (results + '/log_' + current_exp + '_' + net.__class__.__name__ + '_' + args.name + '_'
-                       + str(args.seed) + '.csv')
+                       + str(args.seed))
 
-            if not os.path.exists(logname):
-                with open(logname, 'w') as logfile:
-                    logwriter = csv.writer(logfile, delimiter=',')
-                    logwriter.writerow(['epoch', 'train loss', 'reg loss', 'train acc',
-                                        'test loss', 'test acc'])
+            # Epoch rows (and sampled steps) are buffered and written every --metrics_flush seconds
+            metrics = None
+            if is_main_process():
+                metrics = MetricsSink(logname, args.metrics_format, args.metrics_flush)
 
             if use_cuda:
                 net.cuda()
-                net = torch.nn.DataParallel(net)
-                print(torch.cuda.device_count())
+
+            # The probes below draw random inputs, and only the first trial of a process runs
+            # them; put the RNG back afterwards so training does not depend on that
+            probe_rng = torch.get_rng_state(), torch.cuda.get_rng_state_all() if use_cuda else None
+
+            if args.memory_format == 'auto':
+                if args.model not in memory_formats:
+                    memory_formats[args.model], rates = choose_memory_format(
+                        net, args.batch_size, args.image_size, len(testset.classes))
+                    print('Memory format: NCHW %.1f img/s | channels_last %.1f img/s'
+                          % (rates[torch.contiguous_format], rates[torch.channels_last]))
+                memory_format = memory_formats[args.model]
+                for collate in (collate_train, collate_test):
+                    collate = getattr(collate, 'collate', collate)
+                    if isinstance(collate, BatchAugment):
+                        collate.memory_format = memory_format
+            net = net.to(memory_format=memory_format)
+
+            eval_batch_size = args.eval_batch_size
+            if not eval_batch_size:
+                if args.model not in eval_batch_sizes:
+                    eval_batch_sizes[args.model], rates = choose_eval_batch_size(
+                        net, args.image_size, limit=min(1024, len(testset)), amp=args.amp,
+                        memory_format=memory_format)
+                    print('Eval batch size: %d (%s)' % (eval_batch_sizes[args.model], ' | '.join(
+                        '%d: %.1f img/s' % (n, rate) for n, rate in sorted(rates.items()))))
+                eval_batch_size = eval_batch_sizes[args.model]
+            context.set_eval_batch_size(eval_batch_size)
+            testloader = context.testloader
+
+            if args.compile != 'none':
+                # Warm up every batch shape: micro-batches of the full and last train batch, eval batches
+                rows = 2 if args.mixup_v2 and args.fused_v2 else 1
+                shapes = [(len(micro), True) for n in (args.batch_size, len(trainset) % args.batch_size) if n
+                          for micro in torch.arange(n).split(-(-n // args.accum_steps))]
+                shapes = sorted(set(shapes)) + sorted(set(
+                    [(eval_batch_size, False), (len(testset) % eval_batch_size, False),
+                     (len(trainset) % eval_batch_size, False)]))
+                # Fused train batches run under split_batchnorm like train_step
+                fused = ((lambda model=net: split_batchnorm(model, 2 if args.v2_bn == 'split' else 1))
+                         if rows == 2 else None)
+                examples = [(torch.randn(rows * n if training else n, 3, args.image_size,
+                                         args.image_size, device=device_type
+                                         ).contiguous(memory_format=memory_format), training,
+                             fused if training else None)
+                            for n, training in shapes if n > 0]
+                net, compile_seconds = compile_model(
+                    net, args.compile, examples,
+                    (args.model, args.image_size, len(testset.classes), args.batch_size, args.amp,
+                     str(memory_format), args.accum_steps),
+                    context=lambda: autocast(args.amp, device_type))
+                print('Compile (%s): %s' % (args.compile, '%.1fs' % compile_seconds
+                                             if compile_seconds else 'reused cached graphs'))
+
+            torch.set_rng_state(probe_rng[0])
+            if use_cuda:
+                torch.cuda.set_rng_state_all(probe_rng[1])
+
+            # DistributedDataParallel under torchrun, the bare model otherwise
+            net = wrap_model(net)
+            if use_cuda:
                 cudnn.benchmark = True
                 print('Using CUDA..')
 
+            if args.manifold_mixup:
+                if models.num_stages(net) == 0:
+                    sys.exit('ERROR: --manifold_mixup needs a staged model (ResNet, DenseNet, MobileNet, ResNeXt)')
+                stages = models.num_stages(net)
+                # Stage 0 would mix the raw inputs (plain mixup), a stage past the head mixes nothing
+                if args.manifold_stages and not all(1 <= s < stages for s in args.manifold_stages):
+                    parser.error('--manifold_stages must be between 1 and %d for %s'
+                                 % (stages - 1, args.model))
+                manifold_stages = args.manifold_stages or list(range(1, stages - 1))
+
             criterion = nn.CrossEntropyLoss()
-            optimizer = optim.SGD(net.parameters(), lr=args.lr, momentum=0.9,
+            mix_criterion = MixupCrossEntropy()
+            lr = args.lr
+            if args.lr_scaling == 'linear':
+                lr = scaled_lr(args.lr, args.batch_size * world_size, args.lr_base_batch)
+            optimizer = optim.SGD(net.parameters(), lr=lr, momentum=0.9,
                                   weight_decay=args.decay)
-
-
+            # Sets the learning rate of every step, see schedules.py
+            schedule = build_schedule(args.lr_schedule, optimizer, lr, args.epoch, len(trainloader),
+                                      args.warmup_epochs, args.lr_milestones)
+            if resume_state is not None and 'optimizer' in resume_state:
+                restore(resume_state)
+                if resume_state.get('step'):
+                    resume_sums = resume_state['step'], resume_state['sums']
+            elif resume_state is not None:
+                torch.set_rng_state(resume_state['rng_state'])
+
+
+            timer.reset()
             for epoch in range(start_epoch, args.epoch):
+                context.set_epoch(epoch)
                 train_loss, reg_loss, train_acc = train(epoch)
                 test_loss, test_acc = test(epoch, testloader, current_exp)
-
-                adjust_learning_rate(optimizer, epoch)
-                with open(logname, 'a') as logfile:
-                    logwriter = csv.writer(logfile, delimiter=',')
-                    logwriter.writerow([epoch, train_loss, reg_loss, train_acc.data.item(), test_loss,
-                                    test_acc.data.item()])
+                if args.amp != 'none':
+                    # Reference fp32 passes over the same weights, not counted in the eval phase
+                    amp_seconds = eval_seconds
+                    _, fp32_acc = test(epoch, testloader, current_exp, amp='none', save=False, phase=None)
+                    print('AMP %s: train step speedup %.2fx | eval speedup %.2fx vs fp32 | '
+                          'test acc %.3f%% (%+.3f vs fp32)'
+                          % (args.amp, amp_train_speedup(), eval_seconds / amp_seconds, test_acc,
+                             test_acc - fp32_acc))
+
+                # Successive halving: rank 0 decides, all ranks stop together
+                stop_reason = None
+                if halving is not None and is_main_process():
+                    stop_reason = halving.report(args.name + current_exp, epoch, test_acc.item())
+                stopped = halving is not None and all_reduce_sum(float(stop_reason is not None))[0] > 0
+                # The end-of-epoch snapshot below is counted in the next row
+                times = timer.reset()
+                rank_rng_states = all_gather(rng_state(0)) if args.snapshot_every else None
+                if not is_main_process():
+                    if stopped:
+                        break
+                    continue
+                row = {'epoch': epoch, 'train loss': train_loss, 'reg loss': reg_loss,
+                       'train acc': train_acc.data.item(), 'test loss': test_loss,
+                       'test acc': test_acc.data.item()}
+                if halving:
+                    row['stop reason'] = stop_reason or ''
+                row['lr'] = schedule.current_lr()
+                row.update(phase_columns(times))
+                metrics.write('epoch', epoch, row)
+                if args.snapshot_every:
+                    # The epoch is logged, a resume starts the next one (a stopped trial is done)
+                    metrics.flush()
+                    snapshot(args.epoch if stopped else epoch + 1, 0, None, rank_rng_states)
+
+                if stopped:
+                    print('Stopped early:', stop_reason)
+                    with open(current_dataset_file, 'a') as report:
+                        report.write('Stopped iteration %d experiment: %d for dataset %s: %s\n'
+                                     % (iteration, trial, dataset, stop_reason))
+                    break
 
                 if epoch + 1 == args.epoch:
-                    with open(current_dataset_file, 'a') as f:
-                        checkpoint_result = torch.load(f'./{direct_for_checkpoint}/ckpt.t7' + current_exp + args.name + '_'
-                                                + str(args.seed))
-                        net = checkpoint_result['net']
-                        print("Test result for iteration", iteration, "experiment:", trial, " for dataset ", dataset, file = f)
-                        print(make_prediction(net, testset.classes, testloader, 'save'), file = f)
-
-                        print("Train result for iteration", iteration, "experiment:", trial, "for dataset", dataset, file=f)
-                        print(make_prediction(net, testset.classes, trainloader, 'save'), file=f)
+                    # The report covers the whole datasets (not rank 0's shards), and the
+                    # training images without augmentation or shuffling
+                    report_testloader = testloader
+                    if is_distributed():
+                        report_testloader = context.eval_loader(testset, shard=False, persistent_workers=False)
+                    report_trainloader = context.eval_loader(context.train_evalset, shard=False,
+                                                             persistent_workers=False)
+                    # Appended in one write, so concurrent jobs (scheduler.py) do not interleave
+                    f = io.StringIO()
+                    # The best weights of this trial, once the writer has stored them
+                    writer.flush()
+                    net = eager_module(net)
+                    net.load_state_dict(load_checkpoint(checkpoint_path(current_exp))['net'])
+                    print("Test result for iteration", iteration, "experiment:", trial, " for dataset ", dataset, file = f)
+                    print(make_prediction(net, testset.classes, report_testloader, 'save', args.amp,
+                                          memory_format), file = f)
+
+                    print("Train result for iteration", iteration, "experiment:", trial, "for dataset", dataset, file=f)
+                    print(make_prediction(net, testset.classes, report_trainloader, 'save', args.amp,
+                                          memory_format), file=f)
+                    with open(current_dataset_file, 'a') as report:
+                        report.write(f.getvalue())
+
+            if metrics is not None:
+                metrics.close()
+
+writer.close()
@@ -1,21 +1,29 @@
 '''Some helper functions for PyTorch, including:
     - get_mean_and_std: calculate the mean and std value of dataset.
     - msr_init: net parameter initialization.
-    - progress_bar: progress bar mimic xlua.progress.
+    - progress_bar: rate-limited progress bar mimic xlua.progress (see Progress).
+    - model_step_rate: images/sec a model can train on.
+    - autocast: mixed-precision context for the --amp setting.
+    - choose_memory_format: time NCHW vs. channels_last training for a model.
+    - choose_eval_batch_size: largest inference batch that still pays off.
+    - evaluate: inference-mode pass over a loader, shared by test() and reports.
+    - Predictions/confusion_matrix/classification_report: per-class report
+      of a loader, computed on the device.
 '''
-import os
 import sys
+import copy
+import atexit
+import json
 import time
 import math
+import queue
+import shutil
+import threading
 
 import torch
 import torch.nn as nn
 import torch.nn.init as init
 
-from sklearn.metrics import confusion_matrix
-from sklearn.metrics import accuracy_score
-from sklearn.metrics import classification_report
-
 
 def get_mean_and_std(dataset):
     '''Compute the mean and std value of dataset.'''
@@ -47,54 +55,263 @@ def init_params(net):
                 init.constant(m.bias, 0)
 
 
-_, term_width = os.popen('stty size', 'r').read().split()
-term_width = int(term_width)
+def autocast(amp, device_type='cpu'):
+    '''Autocast context for --amp: 'bf16' runs eligible ops in bfloat16, 'none' is a no-op.'''
+    return torch.autocast(device_type, dtype=torch.bfloat16, enabled=amp == 'bf16')
+
+def model_step_rate(net, batch_size, image_size, num_classes, steps=5,
+                    memory_format=torch.contiguous_format, amp='none'):
+    '''Images/sec of forward + backward + SGD step on synthetic data (forward and loss under `amp`).'''
+    device = next(net.parameters()).device
+    inputs = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    inputs = inputs.contiguous(memory_format=memory_format)
+    targets = torch.randint(0, num_classes, (batch_size,), device=device)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.)
+    net.train()
+    for i in range(steps + 1):
+        if i == 1:
+            # The first step pays for allocator and kernel warm-up.
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+        optimizer.zero_grad()
+        with autocast(amp, device.type):
+            loss = criterion(net(inputs), targets)
+        loss.backward()
+        optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return steps * batch_size / (time.time() - start)
+
+def choose_memory_format(net, batch_size, image_size, num_classes, steps=3):
+    '''Return (faster memory format, {format: images/sec}) for training `net`.
+
+    Both layouts are timed on copies of `net`, so a model for which
+    channels_last regresses (e.g. layout conversions around unsupported
+    ops) is detected and kept in NCHW.
+    '''
+    rates = {}
+    for memory_format in (torch.contiguous_format, torch.channels_last):
+        probe = copy.deepcopy(net).to(memory_format=memory_format)
+        rates[memory_format] = model_step_rate(probe, batch_size, image_size, num_classes,
+                                               steps, memory_format)
+    return max(rates, key=rates.get), rates
+
+def inference_rate(net, batch_size, image_size, steps=3, amp='none',
+                   memory_format=torch.contiguous_format):
+    '''Images/sec of inference-mode forward passes on synthetic data.'''
+    device = next(net.parameters()).device
+    inputs = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    inputs = inputs.contiguous(memory_format=memory_format)
+    with torch.inference_mode(), autocast(amp, device.type):
+        for i in range(steps + 1):
+            if i == 1:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+            net(inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return steps * batch_size / (time.time() - start)
+
+def choose_eval_batch_size(net, image_size, limit=1024, start=8, steps=3, amp='none',
+                           memory_format=torch.contiguous_format, gain=1.1):
+    '''Return (batch size, {batch size: images/sec}) for evaluating `net`.
+
+    The batch size doubles from `start` as long as inference gets at least
+    `gain` times faster, up to `limit` or until the device runs out of memory.
+    Without autograd graphs eval batches can be much larger than train batches.
+    '''
+    training = net.training
+    net.eval()
+    rates = {}
+    best = batch_size = start
+    while batch_size <= max(limit, start):
+        try:
+            rates[batch_size] = inference_rate(net, batch_size, image_size, steps, amp, memory_format)
+        except torch.cuda.OutOfMemoryError:
+            torch.cuda.empty_cache()
+            break
+        if batch_size > start and rates[batch_size] < gain * rates[best]:
+            break
+        best = batch_size
+        batch_size *= 2
+    net.train(training)
+    return best, rates
+
+def prefetch(loader, device, depth=2):
+    '''Iterate `loader` with the next batches loaded while the current one is used.
+
+    Loaders with workers already load ahead; a loader without workers is read
+    by a background thread, up to `depth` batches ahead. Tensors are moved to
+    `device` (asynchronously from pinned memory).
+    '''
+    def to_device(batch):
+        return [t.to(device, non_blocking=True) if torch.is_tensor(t) else t for t in batch]
+
+    if getattr(loader, 'num_workers', 0) > 0:
+        for batch in loader:
+            yield to_device(batch)
+        return
+
+    ready = queue.Queue(depth)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        # Gives up once the consumer has stopped, so the thread always ends
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def load():
+        try:
+            for batch in loader:
+                if not put(batch):
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=load, name='eval-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = ready.get()
+            if batch is done:
+                break
+            if isinstance(batch, BaseException):
+                raise batch
+            yield to_device(batch)
+    finally:
+        stop.set()
+        thread.join()
+
+def evaluate(net, loader, criterion=None, amp='none', memory_format=torch.contiguous_format,
+             collect=None):
+    '''Run `net` over `loader` in inference mode; returns (loss sum, correct, total).
+
+    The loss is summed over samples (None without `criterion`) and the sums stay
+    on the device until the caller reads them. Batches may carry extra entries
+    after (inputs, targets). `collect(predicted, targets)` is called for every
+    batch, e.g. to build a per-class report.
+    '''
+    device = next(net.parameters()).device
+    net.eval()
+    test_loss = torch.zeros((), dtype=torch.float64, device=device) if criterion else None
+    correct = torch.zeros((), dtype=torch.int64, device=device)
+    total = 0
+    with torch.inference_mode():
+        for batch_idx, batch in enumerate(prefetch(loader, device)):
+            inputs, targets = batch[0].contiguous(memory_format=memory_format), batch[1]
+            with autocast(amp, device.type):
+                outputs = net(inputs)
+                if criterion is not None:
+                    test_loss += criterion(outputs, targets).double() * targets.size(0)
+            predicted = outputs.argmax(1)
+            correct += predicted.eq(targets).sum()
+            total += targets.size(0)
+            if collect is not None:
+                collect(predicted, targets)
+
+            if criterion is not None:
+                progress_bar(batch_idx, len(loader),
+                             lambda: 'Loss: %.3f | Acc: %.3f%% (%d/%d)'
+                             % (test_loss/total, 100.*correct/total, correct, total))
+            else:
+                progress_bar(batch_idx, len(loader),
+                             lambda: 'Acc: %.3f%% (%d/%d)' % (100.*correct/total, correct, total))
+    return test_loss, correct, total
+
 
 TOTAL_BAR_LENGTH = 86.
-last_time = time.time()
-begin_time = last_time
+
+class Progress(object):
+    '''Progress reporting that costs next to nothing per batch.
+
+    `update` is meant to be called every batch. It renders only every
+    `every`-th batch, at most `max_rate` times per second, and always on the
+    last batch; `msg` may be a callable so its formatting (and any device
+    sync it triggers) only happens when something is rendered.
+
+    Modes: 'bar' draws a progress bar, redrawn in place on a terminal and one
+    line per render otherwise; 'log' writes JSON lines to `stream`; 'none'
+    writes nothing.
+    '''
+
+    def __init__(self, mode='bar', max_rate=2., every=1, stream=None):
+        self.mode = mode
+        self.interval = 1. / max_rate if max_rate > 0 else 0.
+        self.every = max(every, 1)
+        self.stream = stream or sys.stdout
+        self.current = -1
+        self.begin_time = self.last_render = time.time()
+
+    def update(self, current, total, msg=None):
+        now = time.time()
+        if current == 0 or current <= self.current:
+            self.begin_time = now  # Reset for new bar.
+        self.current = current
+        if self.mode == 'none':
+            return
+        last = current >= total - 1
+        if not last and ((current + 1) % self.every or now - self.last_render < self.interval):
+            return
+        self.last_render = now
+        if callable(msg):
+            msg = msg()
+        if self.mode == 'log':
+            self._log(current, total, msg, now)
+        else:
+            self._bar(current, total, msg, now, last)
+
+    def _log(self, current, total, msg, now):
+        self.stream.write(json.dumps({'time': round(now, 3), 'elapsed': round(now - self.begin_time, 3),
+                                      'step': current + 1, 'total': total, 'msg': msg}) + '\n')
+        self.stream.flush()
+
+    def _bar(self, current, total, msg, now, last):
+        term_width = shutil.get_terminal_size((120, 24)).columns
+        bar_length = int(min(TOTAL_BAR_LENGTH, max(term_width // 3, 10)))
+        cur_len = int(bar_length*(current+1)/total)
+        tot_time = now - self.begin_time
+
+        L = [' [', '=' * max(cur_len - 1, 0), '>', '.' * (bar_length - max(cur_len, 1)), ']',
+             ' %d/%d' % (current+1, total),
+             '  Step: %s' % format_time(tot_time / (current+1)),
+             ' | Tot: %s' % format_time(tot_time)]
+        if msg:
+            L.append(' | ' + msg)
+        line = ''.join(L)
+
+        if self.stream.isatty():
+            line = '\r' + line[:term_width - 1].ljust(term_width - 1)
+            self.stream.write(line + ('\n' if last else ''))
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+
+progress = Progress()
+
+def configure_progress(mode='bar', max_rate=2., every=1, log_path=None):
+    '''Replace the reporter used by progress_bar; a `log_path` file is closed at exit.'''
+    global progress
+    if progress.stream not in (sys.stdout, sys.stderr):
+        progress.stream.close()
+    stream = None
+    if log_path:
+        stream = open(log_path, 'a')
+        atexit.register(stream.close)
+    progress = Progress(mode, max_rate, every, stream)
+
 def progress_bar(current, total, msg=None):
-    global last_time, begin_time
-    if current == 0:
-        begin_time = time.time()  # Reset for new bar.
-
-    cur_len = int(TOTAL_BAR_LENGTH*current/total)
-    rest_len = int(TOTAL_BAR_LENGTH - cur_len) - 1
-
-    sys.stdout.write(' [')
-    for i in range(cur_len):
-        sys.stdout.write('=')
-    sys.stdout.write('>')
-    for i in range(rest_len):
-        sys.stdout.write('.')
-    sys.stdout.write(']')
-
-    cur_time = time.time()
-    step_time = cur_time - last_time
-    last_time = cur_time
-    tot_time = cur_time - begin_time
-
-    L = []
-    L.append('  Step: %s' % format_time(step_time))
-    L.append(' | Tot: %s' % format_time(tot_time))
-    if msg:
-        L.append(' | ' + msg)
-
-    msg = ''.join(L)
-    sys.stdout.write(msg)
-    for i in range(term_width-int(TOTAL_BAR_LENGTH)-len(msg)-3):
-        sys.stdout.write(' ')
-
-    # Go back to the center of the bar.
-    for i in range(term_width-int(TOTAL_BAR_LENGTH/2)):
-        sys.stdout.write('\b')
-    sys.stdout.write(' %d/%d ' % (current+1, total))
-
-    if current < total-1:
-        sys.stdout.write('\r')
-    else:
-        sys.stdout.write('\n')
-    sys.stdout.flush()
+    progress.update(current, total, msg)
 
 def format_time(seconds):
     days = int(seconds / 3600/24)
@@ -128,47 +345,72 @@ def format_time(seconds):
         f = '0ms'
     return f
 
-def get_pred_as_list(test_preds):
+class Predictions(object):
+    '''Collects the predictions and targets of a loader into preallocated buffers.
 
-    result = []
-    for i in range(len(test_preds)):
-        result.append(int(test_preds[i].item()))
+    Pass an instance as `collect` to `evaluate`. The buffers hold `size`
+    samples (`len(loader.dataset)`) on `device` and are filled batch by batch,
+    without copies of what was collected before.
+    '''
 
-    return result
+    def __init__(self, size, device='cpu'):
+        self.preds = torch.empty(size, dtype=torch.int64, device=device)
+        self.targets = torch.empty(size, dtype=torch.int64, device=device)
+        self.count = 0
 
-def make_prediction(net, class_names, loader, name_to_save):
+    def __call__(self, predicted, targets):
+        end = self.count + targets.size(0)
+        self.preds[self.count:end] = predicted
+        self.targets[self.count:end] = targets
+        self.count = end
 
-    test_loss = 0
-    correct = 0
-    total = 0
-    acc = 0
-    all_preds = torch.tensor([]).cuda()
-    ground_truths = torch.tensor([]).cuda()
-    net.eval()
-
-    for batch_idx, (inputs, targets) in enumerate(loader):
-        if torch.cuda.is_available():
-            inputs, targets = inputs.cuda(), targets.cuda()
-            outputs = net(inputs)
+    def confusion_matrix(self, num_classes):
+        return confusion_matrix(self.targets[:self.count], self.preds[:self.count], num_classes)
 
-            _, predicted = torch.max(outputs.data, 1)
-
-            total += targets.size(0)
-            correct += predicted.eq(targets.data).cpu().sum()
+def confusion_matrix(targets, preds, num_classes):
+    '''num_classes x num_classes counts (rows: true class, columns: predicted), as one bincount.'''
+    counts = torch.bincount(targets * num_classes + preds, minlength=num_classes * num_classes)
+    return counts.reshape(num_classes, num_classes)
 
-            ground_truths = torch.cat(
-                  (ground_truths, targets)
-                  ,dim=0
-              )
+def classification_report(cm, class_names, digits=2):
+    '''Per-class precision, recall, F1 and support from a confusion matrix.
 
-            all_preds = torch.cat(
-                  (all_preds, predicted)
-                  ,dim=0
-              )
+    The text has the layout of sklearn.metrics.classification_report; classes
+    without true or predicted samples get 0 where a ratio is undefined.
+    '''
+    cm = cm.double().cpu()
+    tp = cm.diag()
+    support = cm.sum(1)
+    predicted = cm.sum(0)
+    precision = torch.where(predicted > 0, tp / predicted.clamp(min=1), torch.zeros_like(tp))
+    recall = torch.where(support > 0, tp / support.clamp(min=1), torch.zeros_like(tp))
+    f1 = torch.where(precision + recall > 0,
+                     2 * precision * recall / (precision + recall).clamp(min=1e-300),
+                     torch.zeros_like(tp))
+    total = support.sum()
+    weights = support / total if total > 0 else torch.zeros_like(support)
 
-            acc = 100.*correct/total
+    headers = ['precision', 'recall', 'f1-score', 'support']
+    width = max(max(len(name) for name in class_names), len('weighted avg'), digits)
+    row_fmt = '{:>{width}s} ' + ' {:>9.{digits}f}' * 3 + ' {:>9}\n'
+    report = ('{:>{width}s} ' + ' {:>9}' * len(headers)).format('', *headers, width=width) + '\n\n'
+    for name, p, r, f, n in zip(class_names, precision.tolist(), recall.tolist(), f1.tolist(),
+                                support.long().tolist()):
+        report += row_fmt.format(name, p, r, f, n, width=width, digits=digits)
+    report += '\n'
+    accuracy = (tp.sum() / total).item() if total > 0 else 0.
+    report += ('{:>{width}s} ' + ' {:>9.{digits}}' * 2 + ' {:>9.{digits}f}' + ' {:>9}\n').format(
+        'accuracy', '', '', accuracy, int(total), width=width, digits=digits)
+    report += row_fmt.format('macro avg', precision.mean().item(), recall.mean().item(),
+                             f1.mean().item(), int(total), width=width, digits=digits)
+    report += row_fmt.format('weighted avg', (precision * weights).sum().item(),
+                             (recall * weights).sum().item(), (f1 * weights).sum().item(),
+                             int(total), width=width, digits=digits)
+    return report
 
-    targets = get_pred_as_list(ground_truths)
-    preds = get_pred_as_list(all_preds)
-    cm = confusion_matrix(targets, preds)
-    return classification_report(targets, preds, target_names=class_names)
+def make_prediction(net, class_names, loader, name_to_save, amp='none',
+                    memory_format=torch.contiguous_format):
+    '''classification_report of `net` on `loader`, on whatever device `net` is on.'''
+    predictions = Predictions(len(loader.dataset), next(net.parameters()).device)
+    evaluate(net, loader, amp=amp, memory_format=memory_format, collect=predictions)
+    return classification_report(predictions.confusion_matrix(len(class_names)), class_names)